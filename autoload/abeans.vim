@@ -21,6 +21,8 @@ endif
 let g:abeans['addon-dir'] = get(g:abeans, 'addon-dir', expand('<sfile>:h:h'))
 let g:abeans['ctxs'] = get(g:abeans, 'ctxs', {})
 let g:abeans['connected'] = get(g:abeans, 'connected', 0)
+let g:abeans['port'] = get(g:abeans, 'port', 60101)
+let g:abeans['persist'] = get(g:abeans, 'persist', 0)
 
 let g:abeans.currentBuffer = bufnr('%')
 let g:abeans.currentPos = getpos('.')
@@ -30,9 +32,14 @@ import vim
 import sys
 import os
 import re
+import json
+import time
+import hashlib
 import logging
 sys.path.append(vim.eval("g:abeans['addon-dir']") + '/python')
 from LogBeans import *
+from Codec import *
+from VimProcRunner import pidFilename, secretFilename
 
 VIM_BUFFER_OUT_ID = 0
 VIM_BUFFER_OUT_FILENAME = 'vim-async-beans.out'
@@ -41,16 +48,44 @@ VIM_BUFFER_IN_FILENAME = 'vim-async-beans.in'
 
 EXEC_CMD        = "##_EXEC_%d_[%s]_##"
 KILL_CMD        = "##_KILL_%d_##"
+WATCH_CMD       = "##_WATCH_%d_[%s]_##%s"
+UNWATCH_CMD     = "##_UNWATCH_%s_##"
 PAUSE_CMD       = "##_PAUSE_##"
 CONTINUE_CMD    = "##_CONTINUE_##"
+CREDIT_CMD      = "##_CREDIT_%s_%s_%s_##"
+UNLIMITED_CMD   = "##_CREDIT_%s_UNLIMITED_##"
+FETCH_LINES_CMD = "##_FETCH_%s_LINES_%s_%s_##"
+FETCH_BYTES_CMD = "##_FETCH_%s_BYTES_%s_%s_##"
+SESSION_CMD     = "##_SESSION_%s_##"
+AUTH_CMD        = "##_AUTH_%s_##"
+EOF_CMD         = "##_EOF_%s_##"
+FEED_CMD        = "##_FEED_%s_%d_##%s"
+ACK_CMD         = "##_ACK_%d_##"
+PROFILE_CMD     = "##_PROFILE_%s_##"
+MEMORY_CMD      = "##_MEMORY_##"
+WATCHDOG_CMD    = "##_WATCHDOG_%s_##"
 
 RE_STARTED      = re.compile("^##_STARTED_(\d+)_##$")
-RE_TERMINATED   = re.compile("^##_TERMINATED_(\d+)_##$")
+RE_TERMINATED   = re.compile("^##_TERMINATED_(\d+)_(\d+)_##$")
+RE_CANCELLED    = re.compile("^##_CANCELLED_(\d+)_##$")
 RE_DATA         = re.compile("^##_DATA_(\d+)_##(.*)$")
+RE_PROGRESS     = re.compile("^##_PROGRESS_(\d+)_##(.*)$")
+RE_PARTIAL      = re.compile("^##_PARTIAL_(\d+)_##(.*)\|$")
+RE_LINE         = re.compile("^##_LINE_(\d+)_##(.*)$")
+RE_FETCHED      = re.compile("^##_FETCHED_(\d+)_(\d+)_(\d+)_##$")
+RE_BYTES        = re.compile("^##_BYTES_(\d+)_(\d+)_(\d+)_##(.*)\|$")
+RE_ATTACHED     = re.compile("^##_ATTACHED_(\d+)_##([\d,]*)$")
+RE_QUICKFIX     = re.compile("^##_QUICKFIX_(\d+)_##(.*)$")
+RE_STDIN        = re.compile("^##_STDIN_(FULL|READY)_(\d+)_##$")
+RE_SPOOL        = re.compile("^##_SPOOL_(\d+)_(\d+)_(\d+)_##(.+)$")
+RE_TAP          = re.compile("^##_TAP_(\d+)_(\d+)_##(.*)$")
 
 NEXT_CTX_ID = 1
+TRANSPORT = 'netbeans' # or 'channel', see abeans#start()
 
 PENDING_MSGS    = [] # pending messages sent before we got in/out buffers
+SPOOL_FILES     = {} # { id : spool file path } removed once the job is over
+FETCHED_LINES   = {} # { id : [lines] } scrollback lines until ##_FETCHED_
 
 # When using a 'log' variable, we may refer to another one defined somewhere else
 def ablog(): return logging.getLogger('abeans')
@@ -61,6 +96,58 @@ def getNextId():
   NEXT_CTX_ID += 1
   return id
 
+# daemonRunning(): a persistent daemon may be left by a previous vim
+def daemonRunning(port):
+  try:
+    f = open(pidFilename(port))
+    try: pid = int(f.read())
+    finally: f.close()
+    os.kill(pid, 0)
+  except (IOError, OSError, ValueError):
+    return False
+  return True
+
+# startDaemon(): wait for the daemon to listen, it writes its pid file then
+def startDaemon(cmd, port, timeout=2.0):
+  os.system(cmd)
+  end = time.time() + timeout
+  while time.time() < end:
+    if daemonRunning(port): return True
+    time.sleep(0.05)
+  return False
+
+# readSecret(): the daemon only accepts the vim sending it first, '' when
+# the daemon is not running
+def readSecret(port):
+  try:
+    f = open(secretFilename(port))
+    try: return f.read().strip()
+    finally: f.close()
+  except IOError:
+    return ''
+
+# sessionToken(): jobs of a persistent daemon belong to the vim with the
+# same session, g:abeans.session or the working directory by default
+def sessionToken():
+  name = vim.eval("get(g:abeans, 'session', getcwd())")
+  return hashlib.sha1(name).hexdigest()[:16]
+
+# onAttached(): jobs the daemon kept for us while we were away,
+# ids are kept unique across vim restarts
+def onAttached(m):
+  global NEXT_CTX_ID
+  try:
+    lastId = int(m.group(1))
+    ids = [int(id) for id in m.group(2).split(',') if len(id)]
+  except Exception as e:
+    ablog().exception("onAttached: match group exception")
+
+  NEXT_CTX_ID = max(NEXT_CTX_ID, lastId + 1)
+  vim.command("let g:abeans.attached = 1")
+
+  for id in ids:
+    vim.command("call abeans#adopt(%d)" % (id))
+
 def onStarted(m):
   try: id = int(m.group(1))
   except Exception as e:
@@ -70,11 +157,29 @@ def onStarted(m):
   vim.command("call g:abeans.ctxs[%d].started()" % (id))
 
 def onTerminated(m):
-  try: id = int(m.group(1))
+  try:
+    id = int(m.group(1))
+    status = int(m.group(2))
   except Exception as e:
     ablog().exception("onTerminated: match group exception")
 
+  removeSpool(id)
+
   vim.command("let g:abeans.ctxs[%d].running = 0" % (id))
+  vim.command("let g:abeans.ctxs[%d].status = %d" % (id, status))
+  vim.command("call g:abeans.ctxs[%d].terminated()" % (id))
+
+# onCancelled(): job superseded by a newer job with the same key
+def onCancelled(m):
+  try: id = int(m.group(1))
+  except Exception as e:
+    ablog().exception("onCancelled: match group exception")
+
+  removeSpool(id)
+
+  vim.command("let g:abeans.ctxs[%d].running = 0" % (id))
+  vim.command("let g:abeans.ctxs[%d].cancelled = 1" % (id))
+  vim.command("let g:abeans.ctxs[%d].status = -1" % (id))
   vim.command("call g:abeans.ctxs[%d].terminated()" % (id))
 
 def onData(m):
@@ -84,23 +189,190 @@ def onData(m):
   except Exception as e:
     ablog().exception("onData: match group exception")
  
-  data = data.replace("\\", "\\\\").replace('"', '\\\"') + "\n"
+  data = escapeVimString(data + "\n")
 
   ablog().debug("onData: %d : %s", id, data)
 
   vim.command("call g:abeans.ctxs[%d].receive(\"%s\")" % (id, data))
 
+# onProgress(): latest version of a line redrawn by '\r', not terminated yet
+def onProgress(m):
+  try:
+    id = int(m.group(1))
+    data = m.group(2)
+  except Exception as e:
+    ablog().exception("onProgress: match group exception")
+
+  data = escapeVimString(data)
+
+  ablog().debug("onProgress: %d : %s", id, data)
+
+  vim.command("call g:abeans.ctxs[%d].progress(\"%s\")" % (id, data))
+
+# onPartial(): line not terminated yet (a prompt) once the job is idle
+def onPartial(m):
+  try:
+    id = int(m.group(1))
+    data = m.group(2)
+  except Exception as e:
+    ablog().exception("onPartial: match group exception")
+    return
+
+  data = escapeVimString(data)
+
+  ablog().debug("onPartial: %d : %s", id, data)
+
+  vim.command("call g:abeans.ctxs[%d].partial(\"%s\")" % (id, data))
+
+# onTap(): output line of a pipeline stage with the tap option
+def onTap(m):
+  try:
+    id = int(m.group(1))
+    stage = int(m.group(2))
+    data = m.group(3)
+  except Exception as e:
+    ablog().exception("onTap: match group exception")
+    return
+
+  data = escapeVimString(data + "\n")
+
+  vim.command("call g:abeans.ctxs[%d].tapped(%d, \"%s\")" % (id, stage, data))
+
+def onLine(m):
+  try:
+    id = int(m.group(1))
+    data = m.group(2)
+  except Exception as e:
+    ablog().exception("onLine: match group exception")
+
+  FETCHED_LINES.setdefault(id, []).append(data)
+
+def onFetched(m):
+  try:
+    id = int(m.group(1))
+    first = int(m.group(2))
+    total = int(m.group(3))
+  except Exception as e:
+    ablog().exception("onFetched: match group exception")
+
+  lines = FETCHED_LINES.pop(id, [])
+  lines = ', '.join(['"%s"' % (escapeVimString(l)) for l in lines])
+
+  vim.command("call g:abeans.ctxs[%d].fetched(%d, %d, [%s])" % (id, first, total, lines))
+
+def onBytes(m):
+  try:
+    id = int(m.group(1))
+    offset = int(m.group(2))
+    total = int(m.group(3))
+    data = m.group(4)
+  except Exception as e:
+    ablog().exception("onBytes: match group exception")
+
+  data = escapeVimString(unescapeNetBeans(data))
+
+  vim.command("call g:abeans.ctxs[%d].fetchedBytes(%d, %d, \"%s\")" % (id, offset, total, data))
+
+# toVimValue(): vim expression of a json decoded value
+def toVimValue(value):
+  if isinstance(value, (int, long)): return str(value)
+  if isinstance(value, unicode): value = value.encode('latin-1')
+  if isinstance(value, str): return '"%s"' % (escapeVimString(value))
+  if isinstance(value, list): return '[%s]' % (', '.join([toVimValue(v) for v in value]))
+  if isinstance(value, dict):
+    items = ['%s: %s' % (toVimValue(k), toVimValue(v)) for (k, v) in value.items()]
+    return '{%s}' % (', '.join(items))
+  return '0'
+
+# onQuickfix(): records parsed by the daemon with the job 'errorformat'
+def onQuickfix(m):
+  try:
+    id = int(m.group(1))
+    records = json.loads(m.group(2))
+  except Exception as e:
+    ablog().exception("onQuickfix: match group exception")
+    return
+
+  vim.command("call g:abeans.ctxs[%d].quickfix(%s)" % (id, toVimValue(records)))
+
+# onStdin(): job stdin queue full, or drained after being full
+def onStdin(m):
+  try:
+    full = m.group(1) == 'FULL'
+    id = int(m.group(2))
+  except Exception as e:
+    ablog().exception("onStdin: match group exception")
+    return
+
+  vim.command("let g:abeans.ctxs[%d].stdinFull = %d" % (id, full))
+  if not full:
+    vim.command("call g:abeans.ctxs[%d].stdinReady()" % (id))
+
+# onSpool(): job output appended to its spool file, read from there
+def onSpool(m):
+  global SPOOL_FILES
+  try:
+    id = int(m.group(1))
+    offset = int(m.group(2))
+    length = int(m.group(3))
+    path = m.group(4)
+  except Exception as e:
+    ablog().exception("onSpool: match group exception")
+    return
+
+  SPOOL_FILES[id] = path
+  try:
+    f = open(path, 'rb')
+    try:
+      f.seek(offset)
+      data = f.read(length)
+    finally: f.close()
+  except IOError:
+    ablog().exception("onSpool: unable to read %s", path)
+    return
+
+  lines = ', '.join(['"%s"' % (escapeVimString(l)) for l in data.split("\n")[:-1]])
+
+  vim.command("call g:abeans.ctxs[%d].spooled([%s])" % (id, lines))
+
+# removeSpool(): spool file of a job over, the daemon leaves it to us
+def removeSpool(id):
+  path = SPOOL_FILES.pop(id, None)
+  if path == None: return
+  try: os.remove(path)
+  except OSError: pass
+
+# knownCtx(): messages of a job vim doesn't know are dropped, as the ones of
+# a job dropped by the daemon with a previous session
+def knownCtx(id):
+  return vim.eval("has_key(g:abeans.ctxs, %d)" % (id)) == '1'
+
 def parse(line):
-  global RE_STARTED, RE_TERMINATED, RE_DATA
+  global RE_STARTED, RE_TERMINATED, RE_CANCELLED, RE_DATA, RE_PROGRESS, RE_PARTIAL, RE_LINE, RE_FETCHED, RE_BYTES, RE_ATTACHED, RE_QUICKFIX, RE_STDIN, RE_SPOOL, RE_TAP
+  # (regexp, callback, group of the job id)
   regexps = [
-    (RE_STARTED, onStarted),
-    (RE_TERMINATED, onTerminated),
-    (RE_DATA, onData)
+    (RE_STARTED, onStarted, 1),
+    (RE_TERMINATED, onTerminated, 1),
+    (RE_CANCELLED, onCancelled, 1),
+    (RE_DATA, onData, 1),
+    (RE_PROGRESS, onProgress, 1),
+    (RE_PARTIAL, onPartial, 1),
+    (RE_LINE, onLine, 1),
+    (RE_FETCHED, onFetched, 1),
+    (RE_BYTES, onBytes, 1),
+    (RE_ATTACHED, onAttached, None),
+    (RE_QUICKFIX, onQuickfix, 1),
+    (RE_STDIN, onStdin, 2),
+    (RE_SPOOL, onSpool, 1),
+    (RE_TAP, onTap, 1)
   ]
 
-  for (r, cb) in regexps:
+  for (r, cb, idGroup) in regexps:
     m = r.match(line)
     if m == None: continue
+    if idGroup != None and not knownCtx(int(m.group(idGroup))):
+      ablog().warning("parse: unknown job: '%s'" % (line))
+      return
     cb(m)
     return
 
@@ -118,7 +390,9 @@ def updateBuffer(id, f):
 @CatchAndLogException
 def send(data):
   global PENDING_MSGS
-  if VIM_BUFFER_OUT_ID == 0:
+  if TRANSPORT == 'channel':
+    vim.command("call ch_sendraw(g:abeans.channel, \"%s\")" % (escapeVimString(data + "\n")))
+  elif VIM_BUFFER_OUT_ID == 0:
     PENDING_MSGS.append(data)
   else:
     doSend = lambda: vim.buffers[VIM_BUFFER_OUT_ID - 1].append(data)
@@ -147,17 +421,31 @@ def processInput():
 
   updateBuffer(VIM_BUFFER_IN_ID, clear)
 
+  # the daemon notifies again only once acknowledged
+  lines = [l for l in lines if len(l)]
+  send(ACK_CMD % (len(lines)))
+
   cmds = [
     "buffer %s" % (currentBuffer),
     "call setpos('.', g:abeans.currentPos)"
   ]
   vim.command("\n".join(cmds))
 
-  # parse line after switching buffer
+  # parse line after switching buffer, a line failing doesn't lose the next
+  # ones
   for line in lines:
     ablog().debug("processInput: parsing: '%s'", line)
-    parse(line)
+    try: parse(line)
+    except vim.error:
+      ablog().exception("processInput: vim error on: '%s'", line)
+
 
+# channelMessage(): a daemon message given to the channel callback, no
+# buffer to read nor to acknowledge
+@CatchAndLogException
+def channelMessage(line):
+  ablog().debug("channelMessage: parsing: '%s'", line)
+  parse(line)
 
 @CatchAndLogException
 def findBuffers():
@@ -186,6 +474,9 @@ def findBuffers():
       send(data)
     PENDING_MSGS = []
 
+  # first notification, messages already inserted are read on the next one
+  send(ACK_CMD % (0))
+
 _processInput = findBuffers
 
 def setBufferOptions(id):
@@ -201,32 +492,238 @@ def setBufferOptions(id):
   vim.command("\n".join(cmds))
 endpython
 
+" abeans#start()
+" g:abeans.port: daemon port, 60101 by default
+" g:abeans.persist: when non zero, the daemon keeps running the jobs while vim
+" is away and stops after this many seconds without vim. The next vim with
+" the same g:abeans.session (its working directory by default) gets the jobs
+" back, see abeans#adopt().
+" g:abeans.transport: 'channel' to talk to the daemon over a vim channel,
+" messages then go straight to a callback, or 'netbeans' (the default) to
+" go through the NetBeans buffers. The channel needs a vim with +channel.
 fun! abeans#start()
   py LogSetup().setup('abeans', 'abeans.vim.log', False)
-  let beansCooker = g:abeans['addon-dir'] . '/python/VimProcRunner.py -g'
-  py os.system(vim.eval("beansCooker"))
-  sleep 1
-  nbstart:127.0.0.1:60101
-  if has("netbeans_enabled")
-    let g:abeans['connected'] = 1
+  let port = g:abeans.port
+  let beansCooker = g:abeans['addon-dir'] . '/python/VimProcRunner.py -g -p ' . port
+  if g:abeans.persist
+    let beansCooker .= ' -i ' . g:abeans.persist
+  endif
+  let g:abeans.attached = 0
+  py port = int(vim.eval("port"))
+  py if not daemonRunning(port): startDaemon(vim.eval("beansCooker"), port)
+  py vim.command("let secret = '%s'" % (readSecret(port)))
+  let transport = get(g:abeans, 'transport', 'netbeans')
+  if transport == 'channel' && !has('channel')
+    echoe "Warning: vim has no +channel, using the NetBeans transport."
+    let transport = 'netbeans'
+  endif
+  if transport == 'channel'
+    let g:abeans.channel = ch_open('127.0.0.1:' . port, {'mode': 'nl', 'callback': 'abeans#onChannel', 'waittime': 2000})
+    let g:abeans['connected'] = ch_status(g:abeans.channel) == 'open'
   else
-    let g:abeans['connected'] = 0
+    " vim sends the password as AUTH <secret>
+    exe 'nbstart:127.0.0.1:' . port . ':' . secret
+    let g:abeans['connected'] = has("netbeans_enabled")
+  endif
+  if !g:abeans['connected']
     echoe "Error: vim is not connected to VimProcRunner.py, checkout log files for details."
-    finish
+    return
+  endif
+  py TRANSPORT = vim.eval("transport")
+  " first message on a channel, the daemon tells the transport by it
+  if transport == 'channel'
+    py send(AUTH_CMD % (vim.eval("secret")))
   endif
+  py send(SESSION_CMD % (sessionToken()))
+
+  if g:abeans.persist
+    " ids of jobs we get back must not collide with our ids: ours follow the
+    " last one the daemon knows, told by ##_ATTACHED_
+    let waited = 0
+    while !g:abeans.attached && waited < 2000
+      sleep 10m
+      let waited += 10
+    endwhile
+    if !g:abeans.attached
+      echoe "Warning: no answer from VimProcRunner.py, job ids may collide with the ones it kept."
+    endif
+  endif
+endfun
+
+" abeans#onChannel(): callback of the channel transport, one daemon message
+fun! abeans#onChannel(channel, msg)
+  py channelMessage(vim.eval("a:msg"))
 endfun
 
+" abeans#exec()
+" ctx.options (optional) is sent to the daemon with the command:
+" - include, exclude, stripAnsi, maxLineLength, maxLinesPerSec:
+"   output filtering, see python/OutputFilters.py
+" - progressInterval: forward lines redrawn with '\r' to ctx.progress()
+"   at most once per interval (ms)
+" - partialDelay: once the job printed nothing for this delay (ms), give the
+"   line not terminated yet (a prompt like 'Password: ') to ctx.partial().
+"   A newer partial replaces the previous one, the whole line is still given
+"   to ctx.receive() once terminated.
+" - interactive: when non zero, the job output is sent to vim before the
+"   output of other jobs
+" - credits, creditBytes: initial credits, see abeans#grant()
+" - scrollback: size in bytes of the job output kept by the daemon,
+"   see abeans#fetch()
+" - cwd: working directory of the job, the daemon one by default
+" - cache: when non zero, the job is considered deterministic: its output and
+"   exit status are cached by the daemon and replayed while its inputs don't
+"   change. Inputs are the command, cwd and:
+"   - cacheEnv: list of environment variable names
+"   - cacheInputs: list of files, compared by mtime and size or by content
+"     hash when cacheHash is non zero
+"   VimProcRunner.py --cache-dir keeps cached results across restarts.
+" - key: a newer job with the same key supersedes this one: it is cancelled
+"   if not started yet, killed otherwise and its remaining output dropped.
+"   ctx.terminated() is then called with ctx.cancelled set to 1.
+" - debounce: with key, delay (ms) before starting the job, for jobs
+"   triggered on every edit
+" - errorformat: the daemon parses the output (as filtered above) with this
+"   'errorformat' (same syntax, or a list of patterns) and calls
+"   ctx.quickfix(items) with batches of setqflist() items, at most
+"   quickfixBatch (100) at a time. The default ctx.quickfix() adds them to
+"   the quickfix list: call setqflist([]) before starting the job.
+"   Lines are parsed with their indentation, and are still given (stripped)
+"   to ctx.receive() unless quickfixOnly is non zero.
+" - stdinQueue: size in bytes (1MB) of the data written to the job and not
+"   read yet. Once over, ctx.stdinFull is set to 1: stop writing until
+"   ctx.stdinReady() is called. Data written beyond 8 times this size is
+"   dropped.
+" - stdinPipe: when non zero, the job stdin is a pipe instead of its pty so
+"   that abeans#closeStdin() can end it
+" - spool: when non zero, the job output lines (as filtered above) are written
+"   to a file read directly by vim instead of going through NetBeans, for
+"   large outputs. ctx.spooled(lines) is called with the new lines, the
+"   default one calls ctx.receive() for each of them.
+" - pipeline: list of commands run by the daemon upstream of the job, their
+"   output goes to the stdin of the next one without going through vim. A
+"   stage is a command or a dictionary with:
+"   - cmd: the command, its stdout and stderr are read
+"   - name: to refer to the stage in inputs, its index by default
+"   - inputs: stages (listed before) writing to its stdin, the previous one
+"     by default. A stage read by several ones is given to each of them,
+"     stages read by the same one are mixed line by line.
+"   - tap: when non zero, its output is also given to
+"     ctx.tapped(stage index, data)
+"   The job reads the stages listed by the inputs option, the last one by
+"   default. Its stdin is a pipe closed once they are over. The stages are
+"   killed when the job terminates, ctx.status is the status of the job.
+" ctx.status is the exit status of the job once terminated, 255 when it
+" could not be started.
 fun! abeans#exec(ctx)
+  call abeans#setupCtx(a:ctx)
+
+python << endpython
+global EXEC_CMD
+cmd = vim.eval("a:ctx.cmd")
+id = getNextId()
+start = EXEC_CMD % (id, cmd)
+# optional daemon side options, see abeans#exec()
+if int(vim.eval("has_key(a:ctx, 'options')")):
+  start += json.dumps(vim.eval("a:ctx.options"))
+send(start)
+vim.command("let a:ctx.pid = %d" % (id))
+vim.command("let a:ctx.abeans_id = %d" % (id))
+vim.command("let g:abeans.ctxs[%d] = a:ctx" % (id))
+endpython
+
+endfun
+
+" abeans#watch()
+" Have the daemon run ctx.cmd each time files matching ctx.paths change,
+" without going through vim. ctx.paths is a list of files, directories or
+" glob patterns, relative to the cwd option. Each run calls ctx.started(),
+" ctx.receive() and ctx.terminated() as a job started by abeans#exec().
+" ctx.options are the ones of abeans#exec(), plus:
+" - debounce: delay (ms, 200) after the last change before starting the job
+" - recursive: when non zero, directories are watched with their
+"   subdirectories and '*' also matches '/'
+" A change while the job runs starts it again once over.
+fun! abeans#watch(ctx)
+  call abeans#setupCtx(a:ctx)
+
+python << endpython
+options = {}
+if int(vim.eval("has_key(a:ctx, 'options')")):
+  options = vim.eval("a:ctx.options")
+options['paths'] = vim.eval("a:ctx.paths")
+id = getNextId()
+send(WATCH_CMD % (id, vim.eval("a:ctx.cmd"), json.dumps(options)))
+vim.command("let a:ctx.running = 0")
+vim.command("let a:ctx.abeans_id = %d" % (id))
+vim.command("let g:abeans.ctxs[%d] = a:ctx" % (id))
+endpython
+
+endfun
+
+" abeans#unwatch(): stop watching, a running job is left running
+fun! abeans#unwatch(ctx)
+  py send(UNWATCH_CMD % (vim.eval("a:ctx.abeans_id")))
+endfun
+
+" abeans#setupCtx(): default callbacks and methods of a job ctx
+fun! abeans#setupCtx(ctx)
   if !has_key(a:ctx, 'started')
-    fun! ctx.started()
+    fun! a:ctx.started()
     endfun
   endif
 
   if !has_key(a:ctx, 'terminated')
-    fun! ctx.terminated()
+    fun! a:ctx.terminated()
+    endfun
+  endif
+
+  if !has_key(a:ctx, 'progress')
+    fun! a:ctx.progress(data)
+    endfun
+  endif
+
+  if !has_key(a:ctx, 'partial')
+    fun! a:ctx.partial(data)
+    endfun
+  endif
+
+  if !has_key(a:ctx, 'fetched')
+    fun! a:ctx.fetched(first, total, lines)
+    endfun
+  endif
+
+  if !has_key(a:ctx, 'fetchedBytes')
+    fun! a:ctx.fetchedBytes(offset, total, data)
+    endfun
+  endif
+
+  if !has_key(a:ctx, 'quickfix')
+    fun! a:ctx.quickfix(items)
+      call setqflist(a:items, 'a')
+    endfun
+  endif
+
+  if !has_key(a:ctx, 'spooled')
+    fun! a:ctx.spooled(lines)
+      for line in a:lines
+        call self.receive(line."\n")
+      endfor
+    endfun
+  endif
+
+  if !has_key(a:ctx, 'tapped')
+    fun! a:ctx.tapped(stage, data)
+    endfun
+  endif
+
+  if !has_key(a:ctx, 'stdinReady')
+    fun! a:ctx.stdinReady()
     endfun
   endif
 
+  let a:ctx.stdinFull = 0
+
   fun! a:ctx.write(data)
     call abeans#write(self, a:data)
   endfun
@@ -235,28 +732,127 @@ fun! abeans#exec(ctx)
     call abeans#writeAndPause(self, a:data, a:after)
   endfun
 
-python << endpython
-global EXEC_CMD
-cmd = vim.eval("a:ctx.cmd")
-id = getNextId()
-start = EXEC_CMD % (id, cmd)
-send(start)
-vim.command("let a:ctx.pid = %d" % (id))
-vim.command("let a:ctx.abeans_id = %d" % (id))
-vim.command("let g:abeans.ctxs[%d] = a:ctx" % (id))
-endpython
+  fun! a:ctx.closeStdin()
+    call abeans#closeStdin(self)
+  endfun
+
+  fun! a:ctx.feed(path)
+    call abeans#feed(self, a:path)
+  endfun
+
+  fun! a:ctx.feedLines(first, last, ...)
+    call call('abeans#feedLines', [self, a:first, a:last] + a:000)
+  endfun
+
+  fun! a:ctx.grant(messages, ...)
+    call call('abeans#grant', [self, a:messages] + a:000)
+  endfun
+endfun
+
+" abeans#adopt(id)
+" Job started by a previous vim and kept by a persistent daemon: until
+" abeans#attach() is called, its output is collected in ctx.lines.
+fun! abeans#adopt(id)
+  if has_key(g:abeans.ctxs, a:id)
+    return
+  endif
+
+  let ctx = {'abeans_id': a:id, 'pid': a:id, 'running': 1, 'adopted': 1, 'lines': []}
+  fun! ctx.receive(data)
+    call add(self.lines, a:data)
+  endfun
+  call abeans#setupCtx(ctx)
+  let g:abeans.ctxs[a:id] = ctx
+endfun
 
+" abeans#attach(ctx, id)
+" Take over an adopted job: ctx gets the output collected so far, then
+" ctx.terminated() if the job is over already.
+fun! abeans#attach(ctx, id)
+  let adopted = g:abeans.ctxs[a:id]
+  call abeans#setupCtx(a:ctx)
+  let a:ctx.pid = a:id
+  let a:ctx.abeans_id = a:id
+  let a:ctx.running = adopted.running
+  let g:abeans.ctxs[a:id] = a:ctx
+
+  for data in adopted.lines
+    call a:ctx.receive(data)
+  endfor
+
+  if !adopted.running
+    let a:ctx.status = get(adopted, 'status', -1)
+    let a:ctx.cancelled = get(adopted, 'cancelled', 0)
+    call a:ctx.terminated()
+  endif
 endfun
 
 fun! abeans#write(ctx, data)
   py send("##_DATA_%s_##%s" % (vim.eval("a:ctx.abeans_id"), vim.eval("a:data")))
 endfun
 
+" abeans#feed(): write the content of the file at path to the job stdin,
+" read by the daemon as the job consumes it
+fun! abeans#feed(ctx, path)
+  py send(FEED_CMD % (vim.eval("a:ctx.abeans_id"), 0, vim.eval("fnamemodify(a:path, ':p')")))
+endfun
+
+" abeans#feedLines(): write lines first to last of a buffer (current one by
+" default) to the job stdin, through a temporary file removed by the daemon
+fun! abeans#feedLines(ctx, first, last, ...)
+  let buf = a:0 ? a:1 : bufnr('%')
+  let path = tempname()
+  if writefile(getbufline(buf, a:first, a:last), path) != 0
+    echoerr "abeans#feedLines: unable to write ".path
+    return
+  endif
+  py send(FEED_CMD % (vim.eval("a:ctx.abeans_id"), 1, vim.eval("path")))
+endfun
+
+" abeans#closeStdin(): end of the job input (stdinPipe option), sent once the
+" data written before is read by the job
+fun! abeans#closeStdin(ctx)
+  py send(EOF_CMD % (vim.eval("a:ctx.abeans_id")))
+endfun
+
 fun! abeans#writeAndPause(ctx, data, after)
-  py send("##_DATA_%s_AND_PAUSE_AFTER_%s_##%s" % (vim.eval("a:ctx.abeans_id"), vim.eval("a:after"), vim.eval("a:data")))
+  call abeans#grant(a:ctx, a:after)
+  call abeans#write(a:ctx, a:data)
+endfun
+
+" abeans#grant(ctx, messages [, bytes])
+" Allow the job to send given messages (and bytes) more, once exhausted the
+" daemon stops reading its output until more credits are granted.
+" Other jobs are not affected. Jobs are unlimited until a first grant.
+" ctx.terminated() costs no credit.
+fun! abeans#grant(ctx, messages, ...)
+  let bytes = a:0 > 0 ? a:1 : 0
+  py send(CREDIT_CMD % (vim.eval("a:ctx.abeans_id"), vim.eval("a:messages"), vim.eval("bytes")))
+endfun
+
+" abeans#fetch(ctx, start, count)
+" Ask the daemon for lines [start, start + count[ of the job output, lines
+" are numbered from 0 and the oldest ones may have been dropped.
+" ctx.fetched(first, total, lines) is called with the first line available,
+" the total number of lines output so far and the lines.
+fun! abeans#fetch(ctx, start, count)
+  py send(FETCH_LINES_CMD % (vim.eval("a:ctx.abeans_id"), vim.eval("a:start"), vim.eval("a:count")))
+endfun
+
+" abeans#fetchBytes(ctx, offset, length)
+" Same as abeans#fetch() with a byte range,
+" ctx.fetchedBytes(offset, total, data) is called with the data.
+fun! abeans#fetchBytes(ctx, offset, length)
+  py send(FETCH_BYTES_CMD % (vim.eval("a:ctx.abeans_id"), vim.eval("a:offset"), vim.eval("a:length")))
+endfun
+
+" abeans#unlimit(): remove the credit limit of the job
+fun! abeans#unlimit(ctx)
+  py send(UNLIMITED_CMD % (vim.eval("a:ctx.abeans_id")))
 endfun
 
 fun! abeans#kill(ctx)
+  py send(KILL_CMD % (int(vim.eval("a:ctx.abeans_id"))))
 endfun
 
 fun! abeans#processInput()
@@ -273,8 +869,27 @@ fun! abeans#pauseMessages()
   py send(PAUSE_CMD)
 endfun
 
+" abeans#continueMessages(): also remove the credit limits of all jobs
 fun! abeans#continueMessages()
   py ablog().debug("abeans#continueMessages: continuing")
   py send(CONTINUE_CMD)
 endfun
 
+" abeans#profile(): profile the daemon for the given seconds, 0 stops now.
+" The stats file (see the python pstats module) is given in the daemon log,
+" so is the output of abeans#memory() and abeans#watchdog().
+" The daemon also toggles profiling on SIGUSR1.
+fun! abeans#profile(seconds)
+  py send(PROFILE_CMD % (vim.eval("a:seconds")))
+endfun
+
+" abeans#memory(): log the daemon objects and queues, and their growth since
+" the previous call. Also done on SIGUSR2.
+fun! abeans#memory()
+  py send(MEMORY_CMD)
+endfun
+
+" abeans#watchdog(): log what blocks the daemon for ms or longer, 0 disables
+fun! abeans#watchdog(ms)
+  py send(WATCHDOG_CMD % (vim.eval("a:ms")))
+endfun
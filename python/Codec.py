@@ -0,0 +1,90 @@
+# Codec.py
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Escaping shared by the daemon (NetBeans strings) and abeans.vim (vim strings).
+#
+# Escaping is driven by tables of (special char, replacement), applied in
+# order. A text without any special char is returned untouched after a single
+# regex scan; otherwise only the special chars present are replaced, each by
+# a C level str.replace() which is much faster than a python level single pass
+# (see test/BenchCodec.py).
+# Unescaping first splits on escaped backslashes so that "\\n" (backslash
+# followed by n) can't be mistaken for "\n" (newline).
+# Only ASCII chars are special, text is handled as bytes: non UTF-8 job
+# output goes through unchanged and can't be broken in the middle of a
+# multibyte sequence.
+
+import re
+
+# NetBeans quoted strings, see Vim's nb_quote()/nb_unquote():
+# only \" \\ \n \t \r are understood, NUL can't be transported and is dropped
+NETBEANS_ESCAPES = [
+  ('\\', '\\\\'),  # first, before adding new backslashes
+  ('"',  '\\"'),
+  ('\n', '\\n'),
+  ('\t', '\\t'),
+  ('\r', '\\r'),
+  ('\0', '')
+]
+
+# escaped backslashes are handled apart, see unescapeNetBeans()
+NETBEANS_UNESCAPES = [
+  ('\\"', '"'),
+  ('\\n', '\n'),
+  ('\\t', '\t'),
+  ('\\r', '\r')
+]
+
+# Vim double quoted strings: control chars are written as \x.. so they
+# reach vim as is, NUL would end the string and is dropped
+VIM_STRING_ESCAPES = [
+  ('\\', '\\\\'),
+  ('"',  '\\"'),
+  ('\0', '')
+]
+
+VIM_STRING_CONTROLS = {}
+for c in list(range(1, 32)) + [127]:
+  VIM_STRING_CONTROLS[chr(c)] = '\\x%02x' % (c)
+
+def charClass(chars):
+  return re.compile('[' + ''.join([re.escape(c) for c in chars]) + ']')
+
+reNetBeansSpecial   = charClass([c for (c, r) in NETBEANS_ESCAPES])
+reVimStringSpecial  = charClass([c for (c, r) in VIM_STRING_ESCAPES] + list(VIM_STRING_CONTROLS.keys()))
+reVimStringControl  = charClass(VIM_STRING_CONTROLS.keys())
+
+def replaceAll(text, escapes):
+  for (c, r) in escapes:
+    if c in text:
+      text = text.replace(c, r)
+  return text
+
+def escapeNetBeans(text):
+  if reNetBeansSpecial.search(text) == None: return text
+  return replaceAll(text, NETBEANS_ESCAPES)
+
+# unescapeNetBeans(): unknown escapes are left as is
+def unescapeNetBeans(text):
+  if text.find('\\') == -1: return text
+  parts = text.split('\\\\')
+  return '\\'.join([replaceAll(part, NETBEANS_UNESCAPES) for part in parts])
+
+def escapeVimString(text):
+  if reVimStringSpecial.search(text) == None: return text
+  text = replaceAll(text, VIM_STRING_ESCAPES)
+  if reVimStringControl.search(text) == None: return text
+  return reVimStringControl.sub(lambda m: VIM_STRING_CONTROLS[m.group()], text)
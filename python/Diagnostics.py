@@ -0,0 +1,131 @@
+# Diagnostics.py
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import gc
+import time
+import resource
+import tempfile
+import logging
+import cProfile
+
+log = logging.getLogger('abeans.Diagnostics')
+
+DEFAULT_PROFILE_DURATION = 30 # sec profiled when toggled by a signal
+MEMORY_REPORT_TYPES = 15 # object types reported by MemoryTracker
+
+# diagnosticsFilename(): stats file of this daemon process
+def diagnosticsFilename(extension):
+  name = 'vim-async-beans-%d-%d-%s.%s' % (os.getuid(), os.getpid(), time.strftime('%Y%m%d-%H%M%S'), extension)
+  return os.path.join(tempfile.gettempdir(), name)
+
+# class Profiler
+# cProfile enabled for a time window, its stats are written to a file
+# (see pstats) once over.
+class Profiler:
+
+  def __init__(self):
+    self.profile  = None
+    self.end      = None # time at which profiling stops
+
+  def isRunning(self):
+    return self.profile != None
+
+  def start(self, duration):
+    if self.profile == None:
+      self.profile = cProfile.Profile()
+      self.profile.enable()
+    self.end = time.time() + duration
+    log.info("Profiler.start: profiling for %d sec", duration)
+
+  # stop(): return the stats file
+  def stop(self):
+    if self.profile == None: return None
+
+    self.profile.disable()
+    path = diagnosticsFilename('prof')
+    try: self.profile.dump_stats(path)
+    except (IOError, OSError):
+      log.exception("Profiler.stop: unable to write %s", path)
+      path = None
+
+    self.profile = None
+    self.end = None
+    log.info("Profiler.stop: stats written to %s", path)
+    return path
+
+  def toggle(self, duration=DEFAULT_PROFILE_DURATION):
+    if self.isRunning(): self.stop()
+    else: self.start(duration)
+
+  def poll(self, now):
+    if self.end != None and now >= self.end: self.stop()
+
+# class MemoryTracker
+# Python 2 has no tracemalloc: a snapshot counts the objects tracked by the
+# gc by type and is logged with its difference to the previous snapshot,
+# along with the sizes of the daemon queues given by the caller.
+class MemoryTracker:
+
+  def __init__(self):
+    self.previous = None # { type name : count }
+
+  def snapshot(self, sizes):
+    gc.collect()
+    counts = {}
+    for o in gc.get_objects():
+      name = type(o).__name__
+      counts[name] = counts.get(name, 0) + 1
+
+    log.info("MemoryTracker.snapshot: max rss: %d KB, %d objects", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, sum(counts.values()))
+    for (name, size) in sorted(sizes.items()):
+      log.info("MemoryTracker.snapshot: %s: %s", name, str(size))
+
+    if self.previous == None:
+      top = sorted(counts.items(), key=lambda (name, count): -count)
+      for (name, count) in top[:MEMORY_REPORT_TYPES]:
+        log.info("MemoryTracker.snapshot: %s: %d", name, count)
+    else:
+      diff = [(name, count - self.previous.get(name, 0)) for (name, count) in counts.items()]
+      diff = sorted([d for d in diff if d[1] != 0], key=lambda (name, delta): -abs(delta))
+      for (name, delta) in diff[:MEMORY_REPORT_TYPES]:
+        log.info("MemoryTracker.snapshot: %s: %+d (%d)", name, delta, counts[name])
+
+    self.previous = counts
+
+# class Watchdog
+# Times the handlers of the proxy loop, see Proxy.setWatchdog(): a handler
+# running threshold (sec) or longer is logged with what it was given.
+# describe(desc) names a descriptor.
+class Watchdog:
+
+  def __init__(self, threshold, describe):
+    self.threshold  = threshold
+    self.describe   = describe
+
+  # run(): fct(*args), size is the amount of data given to fct if any, or
+  # a function returning it once fct returned
+  def run(self, fct, desc, size, *args):
+    start = time.time()
+    try: return fct(*args)
+    finally:
+      elapsed = time.time() - start
+      if elapsed >= self.threshold:
+        if callable(size): size = size()
+        what = []
+        if desc != None: what.append(self.describe(desc))
+        if size != None: what.append('%d bytes' % (size))
+        log.warning("Watchdog: %s blocked the loop for %.3f sec %s", fct.__name__, elapsed, ', '.join(what))
@@ -0,0 +1,271 @@
+# ErrorFormat.py
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import logging
+
+log = logging.getLogger('abeans.ErrorFormat')
+
+# regex of each %X conversion, as vim does
+FIELD_PATTERNS = {
+  'f': '(.+?)',     # file name
+  'l': '(\d+)',     # line number
+  'c': '(\d+)',     # column
+  'v': '(\d+)',     # virtual column
+  'e': '(\d+)',     # end line number
+  'k': '(\d+)',     # end column
+  'n': '(\d+)',     # error number
+  't': '(.)',       # error type
+  'm': '(.+)',      # message
+  'r': '(.*)',      # rest of the line
+  'p': '([- \t.]*)',# pointer line, gives the column
+  's': '(.+)',      # search text
+  'o': '(.+)'       # module name
+}
+
+# %X regex meta characters
+META_PATTERNS = {'.': '.', '#': '*', '^': '^', '$': '$', '[': '[', '~': '~', '%': '%'}
+
+# %\X vim character classes
+CLASS_PATTERNS = {'a': '[A-Za-z]', 'A': '[^A-Za-z]', 'd': '\d', 'D': '\D',
+                  's': '\s', 'S': '\S', 'w': '\w', 'W': '\W', 'f': '\S'}
+
+KIND_START = ['A', 'E', 'W', 'I']
+KINDS = KIND_START + ['C', 'Z', 'G', 'D', 'X']
+
+# splitErrorFormat(): split a vim 'errorformat' value on its unescaped commas
+def splitErrorFormat(efm):
+  patterns = []
+  current = ''
+  i = 0
+  while i < len(efm):
+    c = efm[i]
+    if c == '\\' and i + 1 < len(efm) and efm[i + 1] == ',':
+      current += ','
+      i += 2
+      continue
+    if c == ',':
+      patterns.append(current)
+      current = ''
+    else:
+      current += c
+    i += 1
+  patterns.append(current)
+  return [p for p in patterns if len(p)]
+
+# class ErrorPattern
+# One errorformat entry compiled to a python regex.
+# kind is None for single line errors, or one of KINDS, flag is '+', '-' or ''
+class ErrorPattern:
+
+  def __init__(self, efm):
+    self.kind   = None
+    self.flag   = ''
+    self.fields = []
+
+    i = 0
+    if efm[:1] == '%' and efm[1:2] in ['+', '-'] and efm[2:3] in KINDS:
+      (self.flag, self.kind, i) = (efm[1], efm[2], 3)
+    elif efm[:1] == '%' and efm[1:2] in KINDS:
+      (self.kind, i) = (efm[1], 2)
+
+    regex = ''
+    while i < len(efm):
+      (pattern, i) = self.convert(efm, i)
+      regex += pattern
+
+    self.regex = re.compile('^' + regex + '$')
+
+  # convert(): regex of the token at efm[i], and the index of the next token
+  def convert(self, efm, i):
+    c = efm[i]
+
+    if c == '\\' and efm[i + 1:i + 2] in [',', '\\']:
+      return (re.escape(efm[i + 1]), i + 2)
+    if c != '%':
+      return (re.escape(c), i + 1)
+
+    c = efm[i + 1:i + 2]
+    if FIELD_PATTERNS.has_key(c):
+      self.fields.append(c)
+      pattern = FIELD_PATTERNS[c]
+      if c == 'f' and i + 2 >= len(efm): pattern = '(.+)'
+      return (pattern, i + 2)
+    if META_PATTERNS.has_key(c):
+      return (META_PATTERNS[c], i + 2)
+    if c == '\\':
+      return (self.convertClass(efm[i + 2:i + 3]), i + 3)
+    if c == '*':
+      # %*[...] and %*\X: scanf like repetition
+      if efm[i + 2:i + 3] == '[':
+        j = i + 3
+        if efm[j:j + 1] == '^': j += 1
+        if efm[j:j + 1] == ']': j += 1
+        end = efm.index(']', j)
+        return (efm[i + 2:end + 1] + '*', end + 1)
+      if efm[i + 2:i + 3] == '\\':
+        return (self.convertClass(efm[i + 3:i + 4]) + '*', i + 4)
+
+    raise ValueError("unsupported errorformat: %s" % (efm))
+
+  def convertClass(self, c):
+    if CLASS_PATTERNS.has_key(c): return CLASS_PATTERNS[c]
+    if not len(c): raise ValueError("unterminated errorformat")
+    return re.escape(c)
+
+  # fill(): set the matched fields of the given quickfix record
+  def fill(self, record, m, line):
+    for (field, value) in zip(self.fields, m.groups()):
+      if field == 'f': record['filename'] = value
+      elif field == 'l': record['lnum'] = int(value)
+      elif field == 'c': record['col'] = int(value)
+      elif field == 'v':
+        record['col'] = int(value)
+        record['vcol'] = 1
+      elif field == 'e': record['end_lnum'] = int(value)
+      elif field == 'k': record['end_col'] = int(value)
+      elif field == 'n': record['nr'] = int(value)
+      elif field == 't': record['type'] = value
+      elif field == 'm' or field == 'r': record['text'] = value
+      elif field == 'p':
+        record['col'] = len(value) + 1
+        record['vcol'] = 1
+      elif field == 's': record['pattern'] = '^\\V' + value.replace('\\', '\\\\') + '\\$'
+      elif field == 'o': record['module'] = value
+
+    if self.flag == '+':
+      record['text'] = line
+
+# class QuickfixParser
+# Turn job output lines into quickfix records (dictionaries as expected by
+# vim setqflist()) according to a vim 'errorformat', either a string as the
+# vim option or a list of patterns.
+# Supported: %f %l %c %v %e %k %n %t %m %r %p %s %o, %*[..] %*\X, %. %# %^ %$
+# %[ %~ %%, multi-line errors (%A %E %W %I %C %Z), %G and directory
+# tracking (%D %X), with the %- and %+ flags. Lines not matching any pattern
+# give invalid records, as vim does.
+class QuickfixParser:
+
+  def __init__(self, errorformat, cwd=None):
+    if isinstance(errorformat, (list, tuple)): entries = list(errorformat)
+    else: entries = splitErrorFormat(errorformat)
+
+    self.patterns = [ErrorPattern(e) for e in entries]
+    self.cwd      = cwd
+    self.dirs     = [] # directory stack, %D and %X
+    self.pending  = None # multi-line record being parsed
+
+  # feed(): parse a line, return the records completed
+  def feed(self, line):
+    records = []
+
+    for pattern in self.patterns:
+      kind = pattern.kind
+      if kind in ['C', 'Z'] and self.pending == None: continue
+
+      m = pattern.regex.match(line)
+      if m == None: continue
+
+      if kind in ['C', 'Z']:
+        self.continueRecord(pattern, m, line)
+        if kind == 'Z': records.append(self.finishRecord())
+        return records
+
+      if self.pending != None:
+        records.append(self.finishRecord())
+
+      if kind == 'G':
+        if pattern.flag != '-':
+          records.append({'text': line, 'valid': 0})
+      elif kind in ['D', 'X']:
+        self.changeDirectory(pattern, m, line)
+      elif kind in KIND_START:
+        self.pending = self.newRecord(pattern, m, line)
+        if kind != 'A' and not self.pending.has_key('type'):
+          self.pending['type'] = kind
+      else:
+        records.append(self.resolve(self.newRecord(pattern, m, line)))
+      return records
+
+    if self.pending != None:
+      records.append(self.finishRecord())
+    records.append({'text': line, 'valid': 0})
+    return records
+
+  # finish(): end of the output, return the last record if any
+  def finish(self):
+    if self.pending == None: return []
+    return [self.finishRecord()]
+
+  def newRecord(self, pattern, m, line):
+    record = {'valid': 1}
+    pattern.fill(record, m, line)
+    return record
+
+  def continueRecord(self, pattern, m, line):
+    if pattern.flag == '-': return
+
+    continued = {}
+    pattern.fill(continued, m, line)
+
+    text = continued.pop('text', None)
+    if text != None:
+      if self.pending.has_key('text'): self.pending['text'] += '\n' + text
+      else: self.pending['text'] = text
+
+    for (key, value) in continued.items():
+      if not self.pending.has_key(key):
+        self.pending[key] = value
+
+  def finishRecord(self):
+    record = self.pending
+    self.pending = None
+    return self.resolve(record)
+
+  def changeDirectory(self, pattern, m, line):
+    record = {}
+    pattern.fill(record, m, line)
+
+    if pattern.kind == 'X':
+      if len(self.dirs): self.dirs.pop()
+      return
+
+    path = record.get('filename')
+    if path == None: return
+    self.dirs.append(self.resolvePath(path))
+
+  def resolvePath(self, path):
+    if os.path.isabs(path): return path
+    if len(self.dirs): return os.path.join(self.dirs[-1], path)
+    if self.cwd: return os.path.join(self.cwd, path)
+    return path
+
+  def resolve(self, record):
+    if record.has_key('filename'):
+      record['filename'] = self.resolvePath(record['filename'])
+    return record
+
+# createQuickfixParser()
+# return a QuickfixParser for the 'errorformat' option of ##_EXEC_, None when
+# missing or invalid
+def createQuickfixParser(options):
+  if not options or not options.get('errorformat'): return None
+
+  try: return QuickfixParser(options.get('errorformat'), options.get('cwd'))
+  except Exception as e:
+    log.exception("createQuickfixParser: invalid errorformat: %s", str(options.get('errorformat')))
+    return None
@@ -0,0 +1,227 @@
+# FileWatch.py
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import glob
+import time
+import errno
+import struct
+import fnmatch
+import logging
+import ctypes
+import ctypes.util
+
+log = logging.getLogger('abeans.FileWatch')
+
+# linux/inotify.h
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ISDIR        = 0x40000000
+IN_CLOEXEC      = 0x00080000
+
+# files written (not each write), renamed, removed or touched: what editors
+# and build tools do
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, name length
+
+# class Inotify
+# Minimal inotify binding through ctypes, the fd is non blocking and meant
+# to be read when select() reports it readable. Raise OSError when inotify
+# is not available.
+class Inotify:
+
+  def __init__(self):
+    name = ctypes.util.find_library('c')
+    if name == None: raise OSError(errno.ENOSYS, "no libc")
+
+    self.libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(self.libc, 'inotify_init1'): raise OSError(errno.ENOSYS, "no inotify")
+
+    self.fd = self.libc.inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0: raise OSError(ctypes.get_errno(), "inotify_init1")
+
+  def fileno(self):
+    return self.fd
+
+  def addWatch(self, path, mask):
+    wd = self.libc.inotify_add_watch(self.fd, path, mask)
+    if wd < 0: raise OSError(ctypes.get_errno(), "inotify_add_watch: " + path)
+    return wd
+
+  def removeWatch(self, wd):
+    self.libc.inotify_rm_watch(self.fd, wd)
+
+  # read(): [(wd, mask, name)] of the events available
+  def read(self):
+    try: data = os.read(self.fd, 64 * 1024)
+    except OSError as e:
+      if e.errno in [errno.EAGAIN, errno.EINTR]: return []
+      raise
+
+    events = []
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+      (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+      offset += EVENT_HEADER.size
+      events.append((wd, mask, data[offset:offset + length].rstrip('\0')))
+      offset += length
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+# fsPath(): paths given to inotify and compared to event names are bytes
+def fsPath(path):
+  if isinstance(path, unicode): return path.encode(sys.getfilesystemencoding() or 'utf-8')
+  return path
+
+# class Watch
+# Job run when files matching patterns change, see FileWatcher.
+# patterns are absolute, a directory stands for everything below it.
+# Changes are coalesced: the job is due debounce (sec) after the last one.
+class Watch:
+
+  def __init__(self, id, cmd, options, patterns, recursive, debounce):
+    self.id         = id
+    self.cmd        = cmd
+    self.options    = options
+    self.patterns   = [fsPath(p) for p in patterns]
+    self.recursive  = recursive
+    self.debounce   = debounce
+    self.dirs       = set() # directories watched for this watch
+    self.due        = None  # time at which the job is to be started
+    self.running    = False
+    self.rerun      = False # changed while running
+
+  def matches(self, path):
+    for pattern in self.patterns:
+      if fnmatch.fnmatchcase(path, pattern): return True
+    return False
+
+  def changed(self, now):
+    self.due = now + self.debounce
+
+# class FileWatcher
+# Watches by id over a single inotify instance. Directories are watched,
+# events are matched against the watch patterns ('*' also matches '/'
+# below recursive watches). New directories are watched by recursive
+# watches as they are created.
+class FileWatcher:
+
+  def __init__(self):
+    self.inotify  = Inotify()
+    self.dirs     = {} # { wd : directory }
+    self.wds      = {} # { directory : wd }
+    self.watches  = {} # { id : Watch }
+
+  def fileno(self):
+    return self.inotify.fileno()
+
+  def add(self, watch):
+    self.remove(watch.id)
+
+    for pattern in list(watch.patterns):
+      if os.path.isdir(pattern):
+        watch.patterns.append(os.path.join(pattern, '*'))
+        dirs = [pattern]
+      else:
+        dirs = [d for d in glob.glob(os.path.dirname(pattern)) if os.path.isdir(d)]
+
+      for d in dirs:
+        self.watchDir(watch, d)
+
+    if not len(watch.dirs):
+      log.error("FileWatcher.add: %d : nothing to watch in %s", watch.id, str(watch.patterns))
+      return False
+
+    self.watches[watch.id] = watch
+    return True
+
+  def watchDir(self, watch, directory):
+    directories = [directory]
+    if watch.recursive:
+      directories = [d for (d, subdirs, files) in os.walk(directory)]
+
+    for d in directories:
+      if not self.wds.has_key(d):
+        try: wd = self.inotify.addWatch(d, WATCH_MASK)
+        except OSError:
+          log.exception("FileWatcher.watchDir: unable to watch %s", d)
+          continue
+        self.wds[d] = wd
+        self.dirs[wd] = d
+      watch.dirs.add(d)
+
+  def remove(self, id):
+    watch = self.watches.pop(id, None)
+    if watch == None: return None
+
+    used = set()
+    for w in self.watches.values():
+      used.update(w.dirs)
+
+    for d in watch.dirs - used:
+      wd = self.wds.pop(d, None)
+      if wd == None: continue
+      del self.dirs[wd]
+      self.inotify.removeWatch(wd)
+    return watch
+
+  # read(): mark the watches matching the pending events as changed
+  def read(self):
+    now = time.time()
+    for (wd, mask, name) in self.inotify.read():
+      if mask & IN_Q_OVERFLOW:
+        log.warning("FileWatcher.read: events lost, triggering all watches")
+        for watch in self.watches.values(): watch.changed(now)
+        continue
+
+      directory = self.dirs.get(wd)
+      if directory == None: continue
+
+      if mask & IN_IGNORED:
+        # directory removed
+        del self.dirs[wd]
+        del self.wds[directory]
+        continue
+
+      path = os.path.join(directory, name)
+      for watch in self.watches.values():
+        if directory not in watch.dirs: continue
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and watch.recursive:
+          self.watchDir(watch, path)
+        if watch.matches(path):
+          watch.changed(now)
+
+  # due(): watches whose job is to be started now
+  def due(self, now):
+    return [w for w in self.watches.values() if w.due != None and w.due <= now]
+
+  def nextDue(self):
+    due = [w.due for w in self.watches.values() if w.due != None]
+    if not len(due): return None
+    return min(due)
+
+  def close(self):
+    self.inotify.close()
@@ -0,0 +1,148 @@
+# FlowControl.py
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import errno
+import logging
+from collections import deque
+
+log = logging.getLogger('abeans.FlowControl')
+
+FEED_BLOCK_SIZE = 64 * 1024 # bytes read at once from a fed file
+
+# class Credits
+# Amount of output vim accepts from a job, in messages and/or in bytes.
+# None means unlimited. When credits are exhausted, the daemon stops reading
+# the job output and the child is blocked by the kernel once its pty is full.
+class Credits:
+
+  def __init__(self):
+    self.messages = None
+    self.bytes    = None
+
+  def isLimited(self):
+    return self.messages != None or self.bytes != None
+
+  def isExhausted(self):
+    if self.messages != None and self.messages <= 0: return True
+    if self.bytes != None and self.bytes <= 0: return True
+    return False
+
+  def grant(self, messages=0, bytes=0):
+    if messages > 0:
+      self.messages = max(self.messages or 0, 0) + messages
+    if bytes > 0:
+      self.bytes = max(self.bytes or 0, 0) + bytes
+
+  def consume(self, size):
+    if self.messages != None: self.messages -= 1
+    if self.bytes != None: self.bytes -= size
+
+  def __str__(self):
+    return "messages: %s, bytes: %s" % (str(self.messages), str(self.bytes))
+
+# class WriteQueue
+# Data waiting to be written to a job stdin, its fd being non blocking.
+# Over maxBytes the queue is full: vim is told to stop writing until it is
+# drained down to half of it. Data is dropped over limitBytes.
+# Files fed with pushFile() are read a block at a time, when the job stdin
+# accepts more: they are not counted in the queue size.
+# eof asks for the job stdin to be closed once drained.
+class WriteQueue:
+
+  def __init__(self, maxBytes, limitBytes):
+    self.maxBytes   = maxBytes
+    self.limitBytes = limitBytes
+    self.chunks     = deque() # str or file objects
+    self.offset     = 0     # bytes of chunks[0] already written
+    self.size       = 0     # bytes waiting
+    self.eof        = False
+    self.full       = False # vim was told the queue is full
+
+  def isEmpty(self):
+    return not len(self.chunks)
+
+  # push(): return False when data is dropped
+  def push(self, data):
+    if self.size + len(data) > self.limitBytes:
+      return False
+
+    self.chunks.append(data)
+    self.size += len(data)
+    return True
+
+  # pushFile(): queue the content of an open file, closed once written
+  def pushFile(self, f):
+    self.chunks.append(f)
+
+  # nextChunk(): first data waiting, read from a fed file if needed
+  def nextChunk(self):
+    while len(self.chunks):
+      chunk = self.chunks[0]
+      if isinstance(chunk, str): return chunk
+
+      try: data = chunk.read(FEED_BLOCK_SIZE)
+      except IOError:
+        log.exception("WriteQueue.nextChunk: error reading %s", chunk.name)
+        data = ''
+
+      if not len(data):
+        chunk.close()
+        self.chunks.popleft()
+        continue
+
+      self.chunks.appendleft(data)
+      self.size += len(data)
+      return data
+
+    return None
+
+  # close(): drop the data waiting and close the fed files
+  def close(self):
+    for chunk in self.chunks:
+      if not isinstance(chunk, str): chunk.close()
+    self.chunks.clear()
+    self.offset = 0
+    self.size = 0
+
+  # write(): write as much as fd accepts without blocking,
+  # return the number of bytes written
+  def write(self, fd):
+    written = 0
+    while True:
+      chunk = self.nextChunk()
+      if chunk == None: break
+
+      try: n = os.write(fd, buffer(chunk, self.offset))
+      except OSError as e:
+        if e.errno in [errno.EAGAIN, errno.EINTR]: break
+        raise
+
+      written += n
+      self.size -= n
+      self.offset += n
+      if self.offset < len(chunk): break # fd is full
+
+      self.chunks.popleft()
+      self.offset = 0
+
+    return written
+
+  def isFull(self):
+    return self.size >= self.maxBytes
+
+  def isLow(self):
+    return self.size <= self.maxBytes / 2
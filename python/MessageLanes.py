@@ -0,0 +1,70 @@
+# MessageLanes.py
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+import logging
+
+log = logging.getLogger('abeans.MessageLanes')
+
+LANE_CONTROL      = 0 # protocol notifications not tied to a job output order
+LANE_INTERACTIVE  = 1 # jobs the user interacts with
+LANE_BULK         = 2 # everything else
+
+LANE_NAMES = ['control', 'interactive', 'bulk']
+
+# class MessageLanes
+# Outbound messages waiting to be sent to vim, one FIFO per priority lane.
+# Messages of a given job must always use the same lane to keep their order.
+# pop() drains higher lanes first; the bulk lane gets one message every
+# starvationLimit messages taken from the upper lanes while it is waiting.
+class MessageLanes:
+
+  def __init__(self, starvationLimit=16):
+    self.lanes            = [deque(), deque(), deque()]
+    self.starvationLimit  = starvationLimit
+    self.skipped          = 0 # nb messages sent while bulk was waiting
+
+  def __len__(self):
+    return len(self.lanes[0]) + len(self.lanes[1]) + len(self.lanes[2])
+
+  def push(self, lane, msg, first=False):
+    if first: self.lanes[lane].appendleft(msg)
+    else: self.lanes[lane].append(msg)
+
+  def messages(self):
+    for lane in self.lanes:
+      for msg in lane:
+        yield msg
+
+  def pop(self):
+    bulk = self.lanes[LANE_BULK]
+
+    if len(bulk) and self.skipped >= self.starvationLimit:
+      self.skipped = 0
+      return bulk.popleft()
+
+    for lane in self.lanes[:LANE_BULK]:
+      if len(lane):
+        if len(bulk): self.skipped += 1
+        return lane.popleft()
+
+    self.skipped = 0
+    if len(bulk):
+      return bulk.popleft()
+    return None
+
+  def stats(self):
+    return ', '.join(["%s: %d" % (LANE_NAMES[i], len(self.lanes[i])) for i in range(len(self.lanes))])
@@ -22,16 +22,23 @@ import os
 import re
 import logging
 
+from Codec import *
+
 log = logging.getLogger('abeans.NetBeans')
 
+# encoded commands and functions: bufId, seq, args
+COMMAND_FORMAT      = "%d:%s!%d\n"
+COMMAND_ARG_FORMAT  = "%d:%s!%d %s\n"
+INSERT_FORMAT       = "%d:insert/%d %d \"%s\"\n"
+
 class EventStack:
   def __init__(self):
     self.events = []
-  def add(self, evtFunction):
-    self.events.append(evtFunction)
+  def add(self, evtFunction, *args):
+    self.events.append((evtFunction, args))
   def execAll(self):
-    for evtFct in self.events:
-      evtFct()
+    for (evtFct, args) in self.events:
+      evtFct(*args)
     self.events = []
 
 class NetBeansCommands:
@@ -158,7 +165,7 @@ class NetBeansParser:
         return False
 
       # Vim is escaping double quotes when sending, we must then unescape
-      text = text.replace("\\\"", "\"").replace("\\\\", "\\")
+      text = unescapeNetBeans(text)
 
       f = lambda: self.eventsHandler.onInsert(bufId, offset, text)
       self.eventStack.add(f)
@@ -214,6 +221,9 @@ class NetBeansParser:
 # - commands and functions formatting and reply handling
 # - basic events handling
 # - buffers management
+# Commands are appended to an output buffer and given to send() right away,
+# or at once by release() when hold() was called before.
+# cmd*() and fun*() hooks are only queued when overloaded.
 class NetBeans(NetBeansEvents, NetBeansCommands, NetBeansFunctions):
 
   def __init__(self):
@@ -225,6 +235,10 @@ class NetBeans(NetBeansEvents, NetBeansCommands, NetBeansFunctions):
     self.nextBuf = 1
     self.nextSeq = 42
 
+    self.output = []          # encoded commands not sent yet
+    self.holding = 0
+    self.hooks = self.overloadedHooks()
+
     self.parser = NetBeansParser(self.eventStack, self, self.onReplyCallback)
 
   # public helpers
@@ -232,6 +246,22 @@ class NetBeans(NetBeansEvents, NetBeansCommands, NetBeansFunctions):
   def send(self, data):
     log.error("NetBeans.send: you must overload this method")
 
+  # hold(): keep commands in the output buffer until release()
+  def hold(self):
+    self.holding += 1
+
+  def release(self):
+    self.holding -= 1
+    if self.holding <= 0:
+      self.holding = 0
+      self.flushOutput()
+
+  def flushOutput(self):
+    if not len(self.output): return
+    data = ''.join(self.output)
+    self.output = []
+    self.send(data)
+
   def process(self, data):
     r = self.parser.parse(data)
     self.eventStack.execAll()
@@ -239,6 +269,21 @@ class NetBeans(NetBeansEvents, NetBeansCommands, NetBeansFunctions):
 
   # private helpers
 
+  # overloadedHooks(): names of the cmd*() and fun*() hooks overloaded by
+  # the subclass, the others are no-ops
+  def overloadedHooks(self):
+    hooks = set()
+    for base in [NetBeansCommands, NetBeansFunctions]:
+      for (name, fct) in base.__dict__.items():
+        if callable(fct) and getattr(self.__class__, name).im_func is not fct:
+          hooks.add(name)
+    return hooks
+
+  def write(self, cmd):
+    self.output.append(cmd)
+    if not self.holding:
+      self.flushOutput()
+
   def onReplyCallback(self, seqId, args):
     if not self.replyCallbacks.has_key(seqId):
       #log.error("NetBeans.onReplyCallback: unknown seqId ("+str(seqId)+")")
@@ -285,47 +330,36 @@ class NetBeans(NetBeansEvents, NetBeansCommands, NetBeansFunctions):
   def create(self):
     bufId = self.getNextBuf()
     self.buffers[bufId] = None
-    (seq, cmd) = self.formatCommand(bufId, 'create')
-    self.send(cmd)
-    f = lambda: self.cmdCreate()
-    self.eventStack.add(f)
+    self.write(COMMAND_FORMAT % (bufId, 'create', self.getNextSeq()))
+    if 'cmdCreate' in self.hooks: self.eventStack.add(self.cmdCreate)
     return bufId
 
   def editFile(self, filename):
     bufId = self.getNextBuf()
     self.buffers[bufId] = filename
-    (seq, cmd) = self.formatCommand(bufId, 'editFile', '"'+filename+'"')
-    self.send(cmd)
-    f = lambda: self.cmdEditFile(bufId, filename)
-    self.eventStack.add(f)
+    self.write(COMMAND_ARG_FORMAT % (bufId, 'editFile', self.getNextSeq(), '"'+filename+'"'))
+    if 'cmdEditFile' in self.hooks: self.eventStack.add(self.cmdEditFile, bufId, filename)
     return bufId
     
   def setFullName(self, bufId, filename):
     self.buffers[bufId] = filename
-    (seq, cmd) = self.formatCommand(bufId, 'setFullName', '"'+filename+'"')
-    self.send(cmd)
-    f = lambda: self.cmdSetFullName(bufId, filename)
-    self.eventStack.add(f)
+    self.write(COMMAND_ARG_FORMAT % (bufId, 'setFullName', self.getNextSeq(), '"'+filename+'"'))
+    if 'cmdSetFullName' in self.hooks: self.eventStack.add(self.cmdSetFullName, bufId, filename)
 
   def startAtomic(self):
-    (seq, cmd) = self.formatCommand(0, 'startAtomic')
-    self.send(cmd)
-    f = lambda: self.cmdStartAtomic()
-    self.eventStack.add(f)
+    self.write(COMMAND_FORMAT % (0, 'startAtomic', self.getNextSeq()))
+    if 'cmdStartAtomic' in self.hooks: self.eventStack.add(self.cmdStartAtomic)
 
   def endAtomic(self):
-    (seq, cmd) = self.formatCommand(0, 'endAtomic')
-    self.send(cmd)
-    f = lambda: self.cmdEndAtomic()
-    self.eventStack.add(f)
+    self.write(COMMAND_FORMAT % (0, 'endAtomic', self.getNextSeq()))
+    if 'cmdEndAtomic' in self.hooks: self.eventStack.add(self.cmdEndAtomic)
 
-  def insert(self, bufId, offset, text):
+  # insert(): text is escaped unless already escaped by the caller
+  def insert(self, bufId, offset, text, escaped=False):
     # Vim expect text to be sent within double quotes, we must then escape them
-    text = text.replace("\\", "\\\\").replace('"', '\\"')
-    (seq, cmd) = self.formatFunction(bufId, 'insert', str(offset)+' '+'"'+text+'"')
-    self.send(cmd)
-    f = lambda: self.cmdInsert(bufId, offset, text)
-    self.eventStack.add(f)
+    if not escaped: text = escapeNetBeans(text)
+    self.write(INSERT_FORMAT % (bufId, self.getNextSeq(), offset, text))
+    if 'cmdInsert' in self.hooks: self.eventStack.add(self.cmdInsert, bufId, offset, text)
 
   def getCursor(self, callback):
     def cb(args):
@@ -342,47 +376,34 @@ class NetBeans(NetBeansEvents, NetBeansCommands, NetBeansFunctions):
 
     (seq, fun) = self.formatFunction(0, 'getCursor')
     self.setReplyCallback(seq, cb)
-    self.send(fun)
-    f = lambda: self.funGetCursor()
-    self.eventStack.add(f)
+    self.write(fun)
+    if 'funGetCursor' in self.hooks: self.eventStack.add(self.funGetCursor)
 
   def setDot(self, bufId, offset):
-    (seq, cmd) = self.formatCommand(bufId, 'setDot', str(offset))
-    self.send(cmd)
-    f = lambda: self.cmdSetDot(bufId, offset)
-    self.eventStack.add(f)
+    self.write(COMMAND_ARG_FORMAT % (bufId, 'setDot', self.getNextSeq(), str(offset)))
+    if 'cmdSetDot' in self.hooks: self.eventStack.add(self.cmdSetDot, bufId, offset)
 
   def putBufferNumber(self, bufId, filename):
     self.buffers[bufId] = filename
-    (seq, cmd) = self.formatCommand(bufId, 'putBufferNumber', '"'+filename+'"')
-    self.send(cmd)
-    f = lambda: self.cmdPutBufferNumber(bufId, filename)
-    self.eventStack.add(f)
+    self.write(COMMAND_ARG_FORMAT % (bufId, 'putBufferNumber', self.getNextSeq(), '"'+filename+'"'))
+    if 'cmdPutBufferNumber' in self.hooks: self.eventStack.add(self.cmdPutBufferNumber, bufId, filename)
 
   def initDone(self, bufId):
-    (seq, cmd) = self.formatCommand(bufId, 'initDone')
-    self.send(cmd)
-    f = lambda: self.cmdInitDone(bufId)
-    self.eventStack.add(f)
+    self.write(COMMAND_FORMAT % (bufId, 'initDone', self.getNextSeq()))
+    if 'cmdInitDone' in self.hooks: self.eventStack.add(self.cmdInitDone, bufId)
 
   def stopDocumentListen(self, bufId):
-    (seq, cmd) = self.formatCommand(bufId, 'stopDocumentListen')
-    self.send(cmd)
-    f = lambda: self.cmdStopDocumentListen(bufId)
-    self.eventStack.add(f)
+    self.write(COMMAND_FORMAT % (bufId, 'stopDocumentListen', self.getNextSeq()))
+    if 'cmdStopDocumentListen' in self.hooks: self.eventStack.add(self.cmdStopDocumentListen, bufId)
 
   def netbeansBuffer(self, bufId, b):
     trueFalse = {True: 'T', False: 'F'}
-    (seq, cmd) = self.formatCommand(bufId, 'netbeansBuffer', trueFalse[b])
-    self.send(cmd)
-    f = lambda: self.cmdNetbeansBuffer(bufId, b)
-    self.eventStack.add(f)
+    self.write(COMMAND_ARG_FORMAT % (bufId, 'netbeansBuffer', self.getNextSeq(), trueFalse[b]))
+    if 'cmdNetbeansBuffer' in self.hooks: self.eventStack.add(self.cmdNetbeansBuffer, bufId, b)
 
   def setReadOnly(self, bufId):
-    (seq, cmd) = self.formatCommand(bufId, 'setReadOnly')
-    self.send(cmd)
-    f = lambda: self.cmdSetReadOnly(bufId)
-    self.eventStack.add(f)
+    self.write(COMMAND_FORMAT % (bufId, 'setReadOnly', self.getNextSeq()))
+    if 'cmdSetReadOnly' in self.hooks: self.eventStack.add(self.cmdSetReadOnly, bufId)
 
   # events
 
@@ -0,0 +1,115 @@
+# OutputFilters.py
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import time
+import logging
+
+log = logging.getLogger('abeans.OutputFilters')
+
+# CSI sequences (colors, cursor moves, ...), OSC sequences (window title)
+# and the remaining two bytes escapes
+reAnsiEscape = re.compile("\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\\\)|[@-Z\\\\-_])")
+
+def toInt(value, default=0):
+  try: return int(value)
+  except: return default
+
+def toList(value):
+  if value == None: return []
+  if isinstance(value, (list, tuple)): return list(value)
+  return [value]
+
+# class OutputTransformer
+# Per job transformations applied on each line read from the process,
+# before anything is sent to vim.
+# Options (all optional), as given by ##_EXEC_:
+# - include:         regex or list of regexps, keep only lines matching one of them
+# - exclude:         regex or list of regexps, drop lines matching one of them
+# - stripAnsi:       remove ANSI escape sequences when non zero
+# - maxLineLength:   truncate lines longer than this
+# - maxLinesPerSec:  drop lines exceeding this rate
+class OutputTransformer:
+
+  def __init__(self, options):
+    self.include        = [re.compile(r) for r in toList(options.get('include'))]
+    self.exclude        = [re.compile(r) for r in toList(options.get('exclude'))]
+    self.stripAnsi      = toInt(options.get('stripAnsi')) != 0
+    self.maxLineLength  = toInt(options.get('maxLineLength'))
+    self.maxLinesPerSec = toInt(options.get('maxLinesPerSec'))
+
+    self.windowStart    = 0.0
+    self.windowLines    = 0
+    self.dropped        = 0 # nb lines dropped by maxLinesPerSec
+
+  def isEmpty(self):
+    return not (self.include or self.exclude or self.stripAnsi or
+                self.maxLineLength > 0 or self.maxLinesPerSec > 0)
+
+  # apply(): return the transformed line or None if it must be dropped
+  def apply(self, line):
+    if self.stripAnsi:
+      line = reAnsiEscape.sub('', line)
+      if not len(line.strip()): return None
+
+    if self.include:
+      got = False
+      for r in self.include:
+        if r.search(line) != None:
+          got = True
+          break
+      if not got: return None
+
+    for r in self.exclude:
+      if r.search(line) != None: return None
+
+    if self.maxLinesPerSec > 0 and not self.allowLine():
+      return None
+
+    if self.maxLineLength > 0 and len(line) > self.maxLineLength:
+      line = line[:self.maxLineLength]
+
+    return line
+
+  def allowLine(self):
+    now = time.time()
+
+    if now - self.windowStart >= 1.0:
+      if self.dropped > 0:
+        log.debug("OutputTransformer.allowLine: %d lines dropped", self.dropped)
+      self.windowStart = now
+      self.windowLines = 0
+      self.dropped = 0
+
+    if self.windowLines >= self.maxLinesPerSec:
+      self.dropped += 1
+      return False
+
+    self.windowLines += 1
+    return True
+
+# createTransformer()
+# return an OutputTransformer or None when options are missing, empty or invalid
+def createTransformer(options):
+  if not options: return None
+
+  try: transformer = OutputTransformer(options)
+  except Exception as e:
+    log.exception("createTransformer: invalid options: %s", str(options))
+    return None
+
+  if transformer.isEmpty(): return None
+  return transformer
@@ -0,0 +1,100 @@
+# Pipeline.py
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from OutputFilters import toInt, toList
+
+log = logging.getLogger('abeans.Pipeline')
+
+STAGE_READ_SIZE = 64 * 1024 # bytes read at once from a stage output
+STAGE_MAX_PARTIAL = 64 * 1024 # unterminated line passed through over this
+
+# class Stage
+# Process upstream of a job, see parsePipeline(). Its stdout (and stderr) is
+# a pipe read by the daemon, whole lines are written to the stdin of its
+# outputs: the job and/or other stages. A tapped stage output is also sent
+# to vim.
+class Stage:
+
+  def __init__(self, jobId, index, cmd, name, tap):
+    self.jobId    = jobId
+    self.index    = index
+    self.cmd      = cmd
+    self.name     = name
+    self.tap      = tap
+    self.inputs   = [] # Stage read by this one
+    self.outputs  = [] # stdin ids written: the job id or Stage.id
+    self.id       = None  # stdin id of the stage when it has inputs
+    self.pid      = None
+    self.desc     = None  # stdout read end
+    self.partial  = ''    # output after the last '\n'
+    self.paused   = False
+
+  # splice(): complete lines of the output read, everything at eof
+  def splice(self, data, eof=False):
+    data = self.partial + data
+    n = data.rfind("\n") + 1
+    if eof or len(data) - n > STAGE_MAX_PARTIAL: n = len(data)
+
+    self.partial = data[n:]
+    return data[:n]
+
+# parsePipeline(): stages of the 'pipeline' option of ##_EXEC_, with the
+# stages read by the job itself ('inputs' option). Raise ValueError when
+# the spec is invalid.
+# A stage is a command, or {"cmd": ..., "name": ..., "inputs": [...],
+# "tap": 0|1}. inputs are names or indexes of stages listed before, the
+# previous stage by default: stages form a DAG by construction.
+# The job reads the last stage by default.
+def parsePipeline(jobId, options):
+  spec = options.get('pipeline')
+  if not spec: return []
+  if not isinstance(spec, list): raise ValueError("pipeline is not a list")
+
+  stages = []
+  names = {}
+  for (index, s) in enumerate(spec):
+    if not isinstance(s, dict): s = {'cmd': s}
+    if not s.get('cmd'): raise ValueError("stage %d has no command" % (index))
+
+    cmd = s['cmd']
+    if isinstance(cmd, unicode): cmd = cmd.encode('utf-8')
+    stage = Stage(jobId, index, cmd, s.get('name', str(index)), toInt(s.get('tap')) != 0)
+
+    inputs = s.get('inputs')
+    if inputs == None:
+      inputs = []
+      if index > 0: inputs = [index - 1]
+    for i in toList(inputs):
+      stage.inputs.append(resolveStage(stages, names, i))
+
+    names[stage.name] = stage
+    stages.append(stage)
+
+  inputs = options.get('inputs')
+  if inputs == None: inputs = [len(stages) - 1]
+  for i in toList(inputs):
+    resolveStage(stages, names, i).outputs.append(jobId)
+
+  return stages
+
+def resolveStage(stages, names, ref):
+  if isinstance(ref, basestring) and names.has_key(ref): return names[ref]
+  try: index = int(ref)
+  except (TypeError, ValueError): raise ValueError("unknown stage: %s" % (str(ref)))
+  if index < 0 or index >= len(stages): raise ValueError("unknown stage: %s" % (str(ref)))
+  return stages[index]
@@ -0,0 +1,166 @@
+# ResultCache.py
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger('abeans.ResultCache')
+
+# cacheKey()
+# Key of a deterministic command: command line, working directory, values of
+# the given environment variables and state of the given input files, either
+# (mtime, size) or a hash of their content.
+def cacheKey(cmd, cwd, envNames=[], inputs=[], hashInputs=False):
+  parts = [cmd, cwd]
+
+  for name in sorted(envNames):
+    parts.append((name, os.environ.get(name)))
+
+  for path in sorted(inputs):
+    if not os.path.isabs(path):
+      path = os.path.join(cwd, path)
+    try:
+      if hashInputs:
+        f = open(path, 'rb')
+        try: state = hashlib.sha1(f.read()).hexdigest()
+        finally: f.close()
+      else:
+        st = os.stat(path)
+        state = (st.st_mtime, st.st_size)
+    except (IOError, OSError):
+      state = None # missing file is part of the state too
+    parts.append((path, state))
+
+  return hashlib.sha1(repr(parts)).hexdigest()
+
+# class CachedResult
+# Complete output lines and exit status of a command
+class CachedResult:
+
+  def __init__(self, status, lines):
+    self.status = status
+    self.lines  = lines
+    self.size   = sum([len(l) + 1 for l in lines])
+
+# class ResultCache
+# CachedResult by key, bounded by maxBytes of output, least recently used
+# evicted first. When directory is given, results are also written there
+# (one json file per key) and loaded back when missing in memory, so they
+# survive a daemon restart.
+class ResultCache:
+
+  def __init__(self, maxBytes, directory=None):
+    self.maxBytes   = maxBytes
+    self.directory  = directory
+    self.results    = OrderedDict() # { key : CachedResult }, least recently used first
+    self.total      = 0
+
+    if self.directory != None:
+      self.setupDirectory()
+
+  def get(self, key):
+    result = self.results.pop(key, None)
+    if result == None:
+      result = self.load(key)
+      if result == None: return None
+      self.total += result.size
+
+    self.results[key] = result
+    self.evict()
+    return result
+
+  def put(self, key, status, lines):
+    result = CachedResult(status, lines)
+    if result.size > self.maxBytes:
+      log.debug("ResultCache.put: %s : too large (%d bytes)", key, result.size)
+      return False
+
+    old = self.results.pop(key, None)
+    if old != None:
+      self.total -= old.size
+
+    self.results[key] = result
+    self.total += result.size
+    self.save(key, result)
+    self.evict()
+    return True
+
+  def evict(self):
+    while self.total > self.maxBytes and len(self.results):
+      (key, result) = self.results.popitem(last=False)
+      self.total -= result.size
+      self.removeFile(key)
+
+  # on disk
+
+  def setupDirectory(self):
+    try:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+    except OSError:
+      log.exception("ResultCache.setupDirectory: unable to create %s", self.directory)
+      self.directory = None
+      return
+
+    # keep most recent files up to maxBytes
+    files = [os.path.join(self.directory, f) for f in os.listdir(self.directory)]
+    files = sorted([f for f in files if os.path.isfile(f)], key=os.path.getmtime, reverse=True)
+    total = 0
+    for f in files:
+      total += os.path.getsize(f)
+      if total > self.maxBytes:
+        self.removeFile(os.path.basename(f))
+
+  def filename(self, key):
+    return os.path.join(self.directory, key)
+
+  def save(self, key, result):
+    if self.directory == None: return
+
+    tmp = self.filename(key) + '.tmp'
+    try:
+      f = open(tmp, 'wb')
+      # latin-1 maps each byte to a char: any output survives json
+      lines = [l.decode('latin-1') for l in result.lines]
+      try: json.dump({'status': result.status, 'lines': lines}, f)
+      finally: f.close()
+      os.rename(tmp, self.filename(key))
+    except (IOError, OSError, ValueError):
+      log.exception("ResultCache.save: unable to write %s", key)
+
+  def load(self, key):
+    if self.directory == None: return None
+
+    try:
+      f = open(self.filename(key), 'rb')
+      try: data = json.load(f)
+      finally: f.close()
+      return CachedResult(data['status'], [l.encode('latin-1') for l in data['lines']])
+    except (IOError, OSError):
+      return None
+    except (ValueError, KeyError):
+      log.exception("ResultCache.load: invalid file %s", key)
+      self.removeFile(key)
+      return None
+
+  def removeFile(self, key):
+    if self.directory == None: return
+
+    try: os.remove(self.filename(key))
+    except OSError: pass
@@ -0,0 +1,167 @@
+# Scrollback.py
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+import logging
+
+log = logging.getLogger('abeans.Scrollback')
+
+# class JobScrollback
+# Most recent output lines of a job.
+# Lines are stored '\n' terminated in a single bytearray, with the absolute
+# end offset of each line in an array: a few bytes of overhead per line.
+# When maxBytes is exceeded, oldest lines are dropped down to 3/4 of it.
+# Line numbers and byte offsets are absolute, counted from the job start.
+class JobScrollback:
+
+  def __init__(self, maxBytes):
+    self.maxBytes   = maxBytes
+    self.data       = bytearray()
+    self.ends       = array('L')  # absolute end offset of each line kept
+    self.firstLine  = 0           # absolute number of the first line kept
+    self.firstByte  = 0           # absolute offset of data[0]
+    self.finished   = False
+
+  def size(self):
+    return len(self.data) + len(self.ends) * self.ends.itemsize
+
+  def lineCount(self):
+    return self.firstLine + len(self.ends)
+
+  def byteCount(self):
+    return self.firstByte + len(self.data)
+
+  def append(self, line):
+    self.data += line
+    self.data += "\n"
+    self.ends.append(self.firstByte + len(self.data))
+
+    if len(self.data) > self.maxBytes:
+      self.trim(self.maxBytes * 3 / 4)
+
+  # trim(): drop oldest lines until at most maxBytes are kept
+  def trim(self, maxBytes):
+    if len(self.data) <= maxBytes or not len(self.ends): return
+
+    need = self.byteCount() - maxBytes
+    n = min(bisect_left(self.ends, need) + 1, len(self.ends))
+    firstByte = self.ends[n - 1]
+
+    del self.data[:firstByte - self.firstByte]
+    del self.ends[:n]
+    self.firstLine += n
+    self.firstByte = firstByte
+
+  def lineStart(self, index):
+    if index == 0: return self.firstByte
+    return self.ends[index - 1]
+
+  # getLines(): return (first line available, [lines])
+  def getLines(self, start, count):
+    start = max(start, self.firstLine)
+    first = start - self.firstLine
+    last = min(first + count, len(self.ends))
+    if first >= last:
+      return (start, [])
+
+    begin = self.lineStart(first) - self.firstByte
+    end = self.ends[last - 1] - self.firstByte - 1 # without the last '\n'
+    return (start, str(self.data[begin:end]).split("\n"))
+
+  # getBytes(): return (first offset available, data)
+  def getBytes(self, offset, length):
+    offset = max(offset, self.firstByte)
+    begin = offset - self.firstByte
+    return (offset, str(self.data[begin:begin + length]))
+
+# class ScrollbackStore
+# Scrollback of all jobs, bounded by maxBytes overall.
+# When over, finished jobs are evicted least recently used first, then the
+# largest running jobs are trimmed.
+# At most maxFinished finished jobs are kept whatever their size, finished
+# jobs without output are dropped.
+class ScrollbackStore:
+
+  def __init__(self, maxBytes, maxJobBytes, maxFinished):
+    self.maxBytes     = maxBytes
+    self.maxJobBytes  = maxJobBytes
+    self.maxFinished  = maxFinished
+    self.jobs         = OrderedDict() # { id : JobScrollback }, least recently used first
+    self.total        = 0
+    self.finished     = 0 # finished jobs kept
+
+  def add(self, id, maxJobBytes=0):
+    if maxJobBytes <= 0:
+      maxJobBytes = self.maxJobBytes
+    self.remove(id)
+    self.jobs[id] = JobScrollback(min(maxJobBytes, self.maxBytes))
+
+  def remove(self, id):
+    job = self.jobs.pop(id, None)
+    if job != None:
+      self.total -= job.size()
+      if job.finished: self.finished -= 1
+
+  def has(self, id):
+    return self.jobs.has_key(id)
+
+  # get(): return the job scrollback and mark it as recently used
+  def get(self, id):
+    job = self.jobs.pop(id, None)
+    if job != None:
+      self.jobs[id] = job
+    return job
+
+  def append(self, id, line):
+    job = self.jobs.get(id)
+    if job == None: return
+
+    size = job.size()
+    job.append(line)
+    self.total += job.size() - size
+
+    if self.total > self.maxBytes:
+      self.evict()
+
+  def finish(self, id):
+    job = self.get(id)
+    if job == None: return
+
+    if not job.lineCount():
+      self.remove(id)
+      return
+
+    job.finished = True
+    self.finished += 1
+    for (id, job) in self.jobs.items():
+      if self.finished <= self.maxFinished: return
+      if job.finished: self.remove(id)
+
+  def evict(self):
+    for (id, job) in self.jobs.items():
+      if self.total <= self.maxBytes: return
+      if not job.finished: continue
+      log.debug("ScrollbackStore.evict: %d : %d bytes", id, job.size())
+      self.remove(id)
+
+    while self.total > self.maxBytes and len(self.jobs):
+      job = max(self.jobs.values(), key=lambda j: j.size())
+      size = job.size()
+      job.trim(len(job.data) / 2)
+      self.total -= size - job.size()
+      if job.size() == size: break
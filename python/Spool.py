@@ -0,0 +1,130 @@
+# Spool.py
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import shutil
+import logging
+
+log = logging.getLogger('abeans.Spool')
+
+# class JobSpool
+# Output lines of a job appended '\n' terminated to a file vim reads
+# directly. Only the range not notified to vim yet is tracked.
+class JobSpool:
+
+  def __init__(self, path):
+    self.path     = path
+    self.file     = open(path, 'wb')
+    self.size     = 0 # bytes written
+    self.notified = 0 # bytes notified to vim
+    self.noticed  = 0 # time of the last notification
+
+  def append(self, line):
+    self.file.write(line)
+    self.file.write("\n")
+    self.size += len(line) + 1
+
+  # pending(): (offset, length) of the data not notified yet, flushed to the
+  # file so that vim can read it, None when there is none
+  def pending(self):
+    if self.notified == self.size: return None
+
+    self.file.flush()
+    pending = (self.notified, self.size - self.notified)
+    self.notified = self.size
+    self.noticed = time.time()
+    return pending
+
+  def isPending(self):
+    return self.notified != self.size
+
+  def close(self):
+    self.file.close()
+
+# class SpoolStore
+# Spool files of the jobs, in a directory private to the daemon created on
+# first use and removed by clear(). Files of finished jobs are left for vim,
+# which removes them once read. Each run of a job id (see watches) has its
+# own file: vim may remove the file of a run while the next one writes.
+# A job output is notified at most once per interval (sec).
+class SpoolStore:
+
+  def __init__(self, directory, interval):
+    self.directory  = directory
+    self.interval   = interval
+    self.jobs       = {} # { id : JobSpool }
+    self.runs       = 0  # spool files created
+
+  def has(self, id):
+    return self.jobs.has_key(id)
+
+  def add(self, id):
+    try:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory, 0700)
+      self.runs += 1
+      self.jobs[id] = JobSpool(os.path.join(self.directory, '%d-%d.spool' % (id, self.runs)))
+    except (IOError, OSError):
+      log.exception("SpoolStore.add: %d : unable to create spool file", id)
+      return False
+    return True
+
+  def append(self, id, line):
+    self.jobs[id].append(line)
+
+  # pending(): [(id, path, offset, length)] of the jobs with data to notify
+  # now, or of the given job whatever the interval
+  def pending(self, id=None):
+    if id != None:
+      jobs = []
+      if self.jobs.has_key(id): jobs.append((id, self.jobs[id]))
+    else:
+      now = time.time()
+      jobs = [(i, j) for (i, j) in self.jobs.items() if now - j.noticed >= self.interval]
+
+    ranges = []
+    for (id, job) in jobs:
+      pending = job.pending()
+      if pending != None:
+        ranges.append((id, job.path, pending[0], pending[1]))
+    return ranges
+
+  # nextDue(): time at which pending() has something to notify, None if never
+  def nextDue(self):
+    due = [job.noticed + self.interval for job in self.jobs.values() if job.isPending()]
+    if not len(due): return None
+    return min(due)
+
+  # finish(): the job is over, its file stays until vim read it
+  def finish(self, id):
+    job = self.jobs.pop(id, None)
+    if job != None: job.close()
+
+  # remove(): the job output won't be read
+  def remove(self, id):
+    job = self.jobs.pop(id, None)
+    if job == None: return
+
+    job.close()
+    try: os.remove(job.path)
+    except OSError: pass
+
+  def clear(self):
+    for job in self.jobs.values():
+      job.close()
+    self.jobs = {}
+    shutil.rmtree(self.directory, ignore_errors=True)
@@ -22,12 +22,31 @@ import pty
 import re
 import socket
 import select
+import time
 import termios
 import tty
+import json
+import errno
+import signal
+import stat
+import binascii
+import hmac
+import tempfile
+import fcntl
 from optparse import OptionParser
 
 from NetBeans import *
 from LogBeans import *
+from OutputFilters import *
+from MessageLanes import *
+from FlowControl import *
+from Scrollback import *
+from ResultCache import *
+from ErrorFormat import *
+from Spool import *
+from FileWatch import *
+from Pipeline import *
+from Diagnostics import *
 
 DEFAULT_LOG_NAME = 'VimProcRunner'
 DEFAULT_LOG_FILENAME = DEFAULT_LOG_NAME + '.log'
@@ -35,9 +54,76 @@ DEFAULT_LOG_FILENAME = DEFAULT_LOG_NAME + '.log'
 DEFAULT_PROXY_IN_FILENAME = 'vim-async-beans.in'
 DEFAULT_PROXY_OUT_FILENAME = 'vim-async-beans.out'
 
+TRANSPORT_NETBEANS = 'netbeans' # messages go through the .in/.out buffers
+TRANSPORT_CHANNEL = 'channel' # vim channel in nl mode, one message per line
+
 DEFAULT_NETBEANS_INTERFACE = 'localhost'
 DEFAULT_NETBEANS_PORT = 60101
 
+DEFAULT_SCROLLBACK_SIZE = 64 * 1024 * 1024  # all jobs
+DEFAULT_SCROLLBACK_JOB_SIZE = 4 * 1024 * 1024
+DEFAULT_SCROLLBACK_FINISHED_JOBS = 256 # finished jobs whose output is kept
+
+DEFAULT_CACHE_SIZE = 32 * 1024 * 1024
+
+DEFAULT_STDIN_QUEUE_SIZE = 1024 * 1024 # vim is asked to stop writing over this
+DEFAULT_STDIN_QUEUE_LIMIT = 8 * DEFAULT_STDIN_QUEUE_SIZE # data is dropped over this
+
+DEFAULT_QUICKFIX_BATCH = 100 # records per ##_QUICKFIX_ message
+
+DEFAULT_SPOOL_INTERVAL = 0.1 # sec between ##_SPOOL_ notices of a job
+
+DEFAULT_WATCH_DEBOUNCE = 200 # ms after the last change before a watch job starts
+DEFAULT_MAX_WATCH_JOBS = 4 # watch jobs running at once
+
+DEFAULT_DETACHED_MAX_MESSAGES = 10000 # jobs are paused over this while detached
+
+# runtimeDirname(): files only the user may read, see makeRuntimeDir()
+def runtimeDirname():
+  return os.path.join(tempfile.gettempdir(), 'vim-async-beans-%d' % (os.getuid()))
+
+# pidFilename(): written once listening, abeans.vim looks for it
+def pidFilename(port):
+  return os.path.join(runtimeDirname(), '%d.pid' % (port))
+
+# secretFilename(): the daemon secret, vim sends it first to be accepted
+def secretFilename(port):
+  return os.path.join(runtimeDirname(), '%d.secret' % (port))
+
+# makeRuntimeDir(): create runtimeDirname() 0700, refuse it if another user
+# could have put it there (owner, mode, symlink)
+def makeRuntimeDir():
+  path = runtimeDirname()
+  try: os.mkdir(path, 0700)
+  except OSError as e:
+    if e.errno != errno.EEXIST: raise
+  st = os.lstat(path)
+  if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 077:
+    raise OSError(errno.EPERM, "not a private directory", path)
+  return path
+
+# writePrivateFile(): a new 0600 file, a symlink or a file left there is
+# never written through
+def writePrivateFile(path, data):
+  try: os.remove(path)
+  except OSError as e:
+    if e.errno != errno.ENOENT: raise
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0600)
+  try: os.write(fd, data)
+  finally: os.close(fd)
+
+# spoolDirname(): spool files of this daemon process, see the spool option
+def spoolDirname():
+  return os.path.join(tempfile.gettempdir(), 'vim-async-beans-%d-%d' % (os.getuid(), os.getpid()))
+
+def setNonBlocking(fd):
+  fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+# setCloseOnExec(): pipe ends kept by the daemon must not be inherited by
+# other jobs, the pipe wouldn't be closed with the daemon end
+def setCloseOnExec(fd):
+  fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
 log = logging.getLogger('VimProcRunner')
 
 class Proxy:
@@ -45,6 +131,17 @@ class Proxy:
   class Handler:
     def fromVim(self, data): pass
     def fromProc(self, desc, data): pass
+    def fromProcProgress(self, desc, data): pass
+    def fromProcPartial(self, desc, data): pass
+    def procEnded(self, desc): pass
+    def procWritable(self, desc): pass # returns the bytes written
+    def vimConnected(self, desc): pass
+    def vimDisconnected(self): pass
+    def poll(self): pass
+    def nextPoll(self): return None # time at which poll() is due
+    def hasPending(self): return False
+    def flush(self): pass
+    def describe(self, desc): return str(desc) # for the watchdog logs
 
   # Simple line buffer: TODO: may contain several lines
   class LineBuffer:
@@ -65,24 +162,185 @@ class Proxy:
           if len(l) > 0:
             readyFct(l)
 
+    # flush(): emit what is left, even without '\n'
+    def flush(self, readyFct):
+      self.add("\n", readyFct)
+
+  # Process line buffer: carriage returns are handled as a terminal would,
+  # a line redrawn with '\r' (progress bars) only keeps its latest version.
+  # Lines keep their indentation (see ProcRunner.jobOutput()), blank lines
+  # are dropped.
+  # When progressInterval (ms) is set, this version is forwarded at most once
+  # per interval until the line is terminated by '\n'.
+  # When partialDelay (ms) is set, a line not terminated (a prompt) is
+  # forwarded once no data came for this delay. Each forwarded version is
+  # the whole line so far, the line is still given once terminated.
+  class ProcLineBuffer(LineBuffer):
+    def __init__(self, progressInterval=0, partialDelay=0):
+      Proxy.LineBuffer.__init__(self)
+      self.progressInterval = progressInterval / 1000.0 # sec
+      self.progress         = None  # latest version not forwarded yet
+      self.progressSent     = 0.0   # time of the last forwarded version
+      self.partialDelay     = partialDelay / 1000.0 # sec
+      self.partialDue       = None  # time at which the line is forwarded
+      self.partialSent      = None  # version of the line forwarded
+
+    @staticmethod
+    def overwrite(text):
+      if text.find("\r") == -1: return text
+      line = ''
+      for seg in text.split("\r"):
+        line = seg + line[len(seg):]
+      return line
+
+    def add(self, data, readyFct):
+      self.buf += data
+
+      while True:
+        n = self.buf.find("\n")
+        if n == -1: break
+
+        l = self.overwrite(self.buf[:n]).rstrip()
+        self.buf = self.buf[n+1:]
+        self.progress = None
+        self.partialSent = None
+        if len(l) > 0:
+          readyFct(l)
+
+      if self.buf.find("\r") != -1:
+        # keep a trailing '\r': next data overwrites the line
+        line = self.overwrite(self.buf)
+        if self.buf[-1:] == "\r": self.buf = line + "\r"
+        else: self.buf = line
+        if self.progressInterval > 0:
+          self.progress = line
+
+      if self.partialDelay > 0:
+        self.partialDue = None
+        if len(self.buf): self.partialDue = time.time() + self.partialDelay
+
+    # nextProgress(): time at which a pending version may be forwarded or None
+    def nextProgress(self):
+      if self.progress == None: return None
+      return self.progressSent + self.progressInterval
+
+    def flushProgress(self, now, progressFct):
+      due = self.nextProgress()
+      if due == None or due > now: return
+
+      l = self.progress.strip()
+      self.progress = None
+      self.progressSent = now
+      if len(l) > 0:
+        self.partialSent = l
+        progressFct(l)
+
+    def nextPartial(self):
+      return self.partialDue
+
+    # flushPartial(): forward the line not terminated once idle, unless
+    # this version was forwarded already (as progress or partial). A prompt
+    # keeps its trailing spaces.
+    def flushPartial(self, now, partialFct):
+      if self.partialDue == None or self.partialDue > now: return
+
+      self.partialDue = None
+      l = self.overwrite(self.buf).replace("\0", '').lstrip()
+      if len(l.rstrip()) > 0 and l != self.partialSent:
+        self.partialSent = l
+        partialFct(l)
+
   def __init__(self, vimDesc, handler):
     self.handler    = handler
 
     self.vimDesc    = vimDesc
 
     self.procDescs  = [] # list of desc
+    self.pausedDescs = set() # desc not read until resumed
+    self.writeDescs = set() # desc with data waiting to be written
+    self.readers    = {} # { desc : callback } other descs to read, see addReader()
 
     self.vimBuffer  = Proxy.LineBuffer()
+    self.vimRefused = False # see refuseVim()
     self.procBuffers = {} # { desc : Proxy.LineBuffer }
 
     self.flagContinue = False
 
+    self.watchdog   = None # see setWatchdog()
+    self.payload    = None # bytes given to the handler timed, see run()
+
+    # persistent mode, see setServer()
+    self.serverDesc     = None
+    self.idleTimeout    = 0
+    self.detachedSince  = None
+
   def stop(self):
     self.flagContinue = False
 
-  def addProc(self, desc):
+  # setWatchdog(): log the handlers blocking the loop threshold (ms) or
+  # longer, 0 disables it. Handlers aren't timed while disabled.
+  def setWatchdog(self, threshold):
+    self.watchdog = None
+    if threshold > 0:
+      self.watchdog = Watchdog(threshold / 1000.0, self.handler.describe)
+    log.info("Proxy.setWatchdog: %d ms", threshold)
+
+  # setServer(): keep running when vim disconnects, accept a new vim
+  # connection on serverDesc, stop after idleTimeout (sec) without vim
+  def setServer(self, serverDesc, idleTimeout):
+    self.serverDesc = serverDesc
+    self.idleTimeout = idleTimeout
+
+  def acceptVim(self, desc):
+    try: (con, addr) = self.serverDesc.accept()
+    except:
+      log.exception("Proxy.acceptVim: exception")
+      return True
+
+    if self.vimDesc != None:
+      log.warning("Proxy.acceptVim: vim already connected, refusing %s", str(addr))
+      con.close()
+      return True
+
+    log.info("Proxy.acceptVim: vim is back")
+    self.vimDesc = con
+    self.vimBuffer = Proxy.LineBuffer()
+    self.detachedSince = None
+    self.handler.vimConnected(con)
+    return True
+
+  # refuseVim(): the handler doesn't want this vim, it is disconnected
+  # once its data is handled
+  def refuseVim(self):
+    self.vimRefused = True
+
+  # detachVim(): return False when the proxy must stop
+  def detachVim(self):
+    try: self.vimDesc.close()
+    except: pass
+
+    self.vimDesc = None
+    self.detachedSince = time.time()
+    self.handler.vimDisconnected()
+
+    return self.serverDesc != None
+
+  def addProc(self, desc, progressInterval=0, partialDelay=0):
     self.procDescs.append(desc)
-    self.procBuffers[desc] = Proxy.LineBuffer()
+    self.procBuffers[desc] = Proxy.ProcLineBuffer(progressInterval, partialDelay)
+
+  # addReader(): call callback(desc) when desc is readable, it returns False
+  # to stop the proxy
+  def addReader(self, desc, callback):
+    self.readers[desc] = callback
+
+  def removeReader(self, desc):
+    self.readers.pop(desc, None)
+
+  # wantWrite(): call handler.procWritable(desc) when desc accepts data
+  def wantWrite(self, desc, want=True):
+    if want: self.writeDescs.add(desc)
+    else: self.writeDescs.discard(desc)
 
   def removeProc(self, desc):
     descs = []
@@ -91,42 +349,91 @@ class Proxy:
       descs.append(d)
     self.procDescs = descs
     del self.procBuffers[desc]
+    self.pausedDescs.discard(desc)
+    self.writeDescs.discard(desc)
+
+  # pauseProc(): stop reading from desc, the process blocks when its pty is full
+  def pauseProc(self, desc):
+    self.pausedDescs.add(desc)
+
+  def resumeProc(self, desc):
+    self.pausedDescs.discard(desc)
 
   def readFromVim(self, desc):
     try: data = self.vimDesc.recv(4096)
     except:
       log.exception("Proxy.readFromVim: exception")
-      return False
-
-    def ok(data):
-      self.handler.fromVim(data)
-
-    self.vimBuffer.add(data, ok)
+      return self.detachVim()
+
+    if not len(data):
+      log.info("Proxy.readFromVim: vim disconnected")
+      return self.detachVim()
+
+    # timed by the watchdog as a whole, see run()
+    self.payload = len(data)
+    self.vimBuffer.add(data, self.handler.fromVim)
+    if self.vimRefused:
+      self.vimRefused = False
+      return self.detachVim()
     return True
 
+  # readFromProc(): a process closing its pty (EIO) only ends this process
   def readFromProc(self, desc):
     try: data = os.read(desc, 4096)
-    except:
-      log.exception("Proxy.readFromProc: exception")
-      return False
+    except OSError as e:
+      if e.errno in [errno.EAGAIN, errno.EINTR]: return True
+      if e.errno != errno.EIO:
+        log.exception("Proxy.readFromProc: exception")
+      data = ''
 
     def ok(data):
       self.handler.fromProc(desc, data)
 
+    self.payload = len(data)
+    if not len(data):
+      self.procBuffers[desc].flush(ok)
+      self.removeProc(desc)
+      self.handler.procEnded(desc)
+      return True
+
     self.procBuffers[desc].add(data, ok)
     return True
 
+  def writeToProc(self, desc):
+    self.payload = self.handler.procWritable(desc)
+
+  # flushProgress(): progress and partial lines due
+  def flushProgress(self):
+    now = time.time()
+    for (desc, buf) in self.procBuffers.items():
+      buf.flushProgress(now, lambda data: self.handler.fromProcProgress(desc, data))
+      buf.flushPartial(now, lambda data: self.handler.fromProcPartial(desc, data))
+
+  # nextTimeout(): select() timeout, shortened when a progress or partial
+  # line is due or when the handler has something left to send
+  def nextTimeout(self, timeout):
+    if self.handler.hasPending(): return 0.0
+
+    now = time.time()
+    dues = [buf.nextProgress() for buf in self.procBuffers.values()]
+    dues.extend([buf.nextPartial() for buf in self.procBuffers.values()])
+    dues.append(self.handler.nextPoll())
+    for due in dues:
+      if due != None:
+        timeout = min(timeout, max(0.0, due - now))
+    return timeout
+
   def run(self):
 
-    def vimError():
+    def vimError(desc):
       log.error("Proxy.run: error reading from vim")
-      return False
+      return self.detachVim()
 
     def procError(desc):
+      if desc not in self.procDescs: return True # ended while reading
       log.error("Proxy.run: error reading from process")
       return False
 
-    output = []
     timeout = 0.1 # sec
 
     log.debug("Start running proxy")
@@ -135,32 +442,79 @@ class Proxy:
 
     while self.flagContinue:
 
-      input = [self.vimDesc]
-      input.extend(self.procDescs)
-      error = [self.vimDesc]
+      input = []
+      error = []
+      inputHandlers = {}
+      errorHandlers = {}
+
+      if self.vimDesc != None:
+        input.append(self.vimDesc)
+        error.append(self.vimDesc)
+        inputHandlers[self.vimDesc] = self.readFromVim
+        errorHandlers[self.vimDesc] = vimError
+      elif time.time() - self.detachedSince > self.idleTimeout:
+        log.info("Proxy.run: no vim for %d sec, stopping", self.idleTimeout)
+        self.flagContinue = False
+        continue
+
+      if self.serverDesc != None:
+        input.append(self.serverDesc)
+        inputHandlers[self.serverDesc] = self.acceptVim
+
+      input.extend([d for d in self.procDescs if d not in self.pausedDescs])
       error.extend(self.procDescs)
+      output = list(self.writeDescs)
 
-      inputHandlers = {self.vimDesc: self.readFromVim}
-      errorHandlers = {self.vimDesc: vimError}
+      input.extend(self.readers.keys())
+      inputHandlers.update(self.readers)
 
       for desc in self.procDescs:
         inputHandlers[desc] = self.readFromProc
         errorHandlers[desc] = procError
       
       try:
-        (i, o, e) = select.select(input, output, error, timeout)
+        (i, o, e) = select.select(input, output, error, self.nextTimeout(timeout))
+      except select.error as err:
+        if err.args[0] != errno.EINTR:
+          log.exception("Proxy.run: error while selecting")
+          self.flagContinue = False
+          continue
+        (i, o, e) = ([], [], []) # signal, handled by poll()
       except:
         log.exception("Proxy.run: interrupted while selecting")
         self.flagContinue = False
         continue
 
+      watchdog = self.watchdog
+
+      payload = lambda: self.payload
+
+      for oo in o:
+        if oo in self.writeDescs:
+          self.payload = None
+          if watchdog == None: self.writeToProc(oo)
+          else: watchdog.run(self.writeToProc, oo, payload, oo)
+
       for ii in i:
-        if not inputHandlers[ii](ii):
+        self.payload = None
+        if watchdog == None: ok = inputHandlers[ii](ii)
+        else: ok = watchdog.run(inputHandlers[ii], ii, payload, ii)
+        if not ok:
           self.flagContinue = False
 
       for ee in e:
-        if not errorHandlers[ee](ee):
-          self.flagContinue = False
+        if ee == self.vimDesc or ee in self.procDescs:
+          if not errorHandlers[ee](ee):
+            self.flagContinue = False
+
+      if watchdog == None:
+        self.flushProgress()
+        self.handler.poll()
+        self.handler.flush()
+      else:
+        watchdog.run(self.flushProgress, None, None)
+        watchdog.run(self.handler.poll, None, None)
+        watchdog.run(self.handler.flush, None, None)
 
 # class ProcRunner
 # Specific to vim async, provide insert data handling and buffering
@@ -173,6 +527,23 @@ class ProcRunner(NetBeans, Proxy.Handler):
 
     self.processes            = {} # { id : desc }
     self.invProcesses         = {} # { desc : id }
+    self.pids                 = {} # { id : pid }
+    self.endedPids            = {} # { id : pid } output ended, not reaped yet
+    self.keyedJobs            = {} # { key : id } latest job started for a key
+    self.pendingJobs          = {} # { key : (id, cmd, options, due) } debounced
+    self.cancelledJobs        = set() # id of jobs superseded by a newer one
+    self.droppedJobs          = set() # id of cancelled jobs of a previous session, see dropJobs()
+    self.transformers         = {} # { id : OutputTransformer }
+    self.quickfix             = {} # { id : (QuickfixParser, batch size, quickfix only) }
+    self.quickfixBatches      = {} # { id : [records] } not sent yet
+    self.stdinQueues          = {} # { id : WriteQueue }
+    self.stdinPipes           = {} # { id : desc } job stdin when not its pty
+    self.invStdinPipes        = {} # { desc : id }
+    self.pipelines            = {} # { id : [Stage] } stages of a job still running
+    self.stageDescs           = {} # { desc : Stage } stage outputs being read
+    self.feeders              = {} # { stdin id : [Stage] } stages writing to a stdin
+    self.endedStages          = [] # Stage whose output ended, not reaped yet
+    self.lastStageId          = 0  # stage stdin ids are negative
 
     self.vimProxyInId         = 0
     self.vimProxyInFilename   = DEFAULT_PROXY_IN_FILENAME
@@ -181,21 +552,82 @@ class ProcRunner(NetBeans, Proxy.Handler):
 
     self.main                 = main
     self.buffersInserts       = {}  # { id : [insert1, insert2, ...] }
+    self.transport            = None # TRANSPORT_*, told by the first line vim sends
+    self.authenticated        = main.secret == None # see checkSecret()
 
-    self.reProtoExecCmd     = re.compile("^##_EXEC_(\d+)_\[(.*)\]_##$")
+    self.reProtoExecCmd     = re.compile("^##_EXEC_(\d+)_\[(.*)\]_##(\{.*\})?$")
     self.reProtoKillCmd     = re.compile("^##_KILL_(\d+)_##$")
     self.reProtoDataCmd     = re.compile("^##_DATA_(\d+)_##(.*)$")
-    self.reProtoDataAndPauseCmd     = re.compile("^##_DATA_(\d+)_AND_PAUSE_AFTER_(\d+)_##(.*)$")
+    self.reProtoEofCmd      = re.compile("^##_EOF_(\d+)_##$")
+    self.reProtoFeedCmd     = re.compile("^##_FEED_(\d+)_([01])_##(.+)$")
+    self.reProtoCreditCmd   = re.compile("^##_CREDIT_(\d+)_(\d+)_(\d+)_##$")
+    self.reProtoUnlimitedCmd = re.compile("^##_CREDIT_(\d+)_UNLIMITED_##$")
+    self.reProtoFetchLinesCmd = re.compile("^##_FETCH_(\d+)_LINES_(\d+)_(\d+)_##$")
+    self.reProtoFetchBytesCmd = re.compile("^##_FETCH_(\d+)_BYTES_(\d+)_(\d+)_##$")
+    self.reProtoSessionCmd  = re.compile("^##_SESSION_([0-9a-zA-Z]+)_##$")
     self.reProtoPauseCmd    = re.compile("^##_PAUSE_##$")
     self.reProtoContinueCmd = re.compile("^##_CONTINUE_##$")
+    self.reProtoAckCmd      = re.compile("^##_ACK_(\d+)_##$")
+    self.reProtoWatchCmd    = re.compile("^##_WATCH_(\d+)_\[(.*)\]_##(\{.*\})$")
+    self.reProtoUnwatchCmd  = re.compile("^##_UNWATCH_(\d+)_##$")
+    self.reProtoProfileCmd  = re.compile("^##_PROFILE_(\d+)_##$")
+    self.reProtoMemoryCmd   = re.compile("^##_MEMORY_##$")
+    self.reProtoWatchdogCmd = re.compile("^##_WATCHDOG_(\d+)_##$")
+    self.reProtoAuthCmd     = re.compile("^##_AUTH_([0-9a-f]+)_##$")
+    self.reNetBeansAuth     = re.compile("^AUTH ([0-9a-f]+)$")
     self.protoStarted       = "##_STARTED_%d_##"
-    self.protoTerminated    = "##_TERMINATED_%d_##"
+    self.protoTerminated    = "##_TERMINATED_%d_%d_##" # id, exit status
+    self.protoCancelled     = "##_CANCELLED_%d_##"
+    self.protoAttached      = "##_ATTACHED_%d_##%s" # last job id, job ids
     self.protoData          = "##_DATA_%d_##%s"
+    self.protoProgress      = "##_PROGRESS_%d_##%s"
+    self.protoPartial       = "##_PARTIAL_%d_##%s|" # line not terminated yet, '|' keeps trailing spaces
+    self.protoLine          = "##_LINE_%d_##%s"
+    self.protoFetched       = "##_FETCHED_%d_%d_%d_##"
+    self.protoBytes         = "##_BYTES_%d_%d_%d_##%s|" # '|' keeps trailing spaces
+    self.protoQuickfix      = "##_QUICKFIX_%d_##%s" # json list of setqflist() records
+    self.protoStdinFull     = "##_STDIN_FULL_%d_##"
+    self.protoStdinReady    = "##_STDIN_READY_%d_##"
+    self.protoSpool         = "##_SPOOL_%d_%d_%d_##%s" # offset, length, spool file
+    self.protoTap           = "##_TAP_%d_%d_##%s" # id, stage index, line
 
     self.isPause            = False
-    self.pausedMessages     = []
-    self.pauseAfter         = 0 # nb messages to count before pausing
-    self.pauseAfterProcId   = 0 # id of the process to count message from
+
+    # .in buffer notifications, see flush()
+    self.inserted           = 0 # messages inserted since vim connected
+    self.acked              = 0 # messages vim acknowledged
+    self.notified           = False # initDone sent, not acknowledged yet
+    self.lanes              = MessageLanes() # [(id, data)], id is None for control messages
+    self.jobLanes           = {} # { id : lane }
+    self.maxBurst           = 256 # nb messages sent to vim per proxy loop
+
+    self.credits            = {} # { id : Credits }
+    self.heldMessages       = {} # { id : [data] } read while out of credits
+    self.heldStatus         = {} # { id : ##_TERMINATED_ } sent after the held messages
+
+    self.scrollback         = ScrollbackStore(DEFAULT_SCROLLBACK_SIZE, DEFAULT_SCROLLBACK_JOB_SIZE, DEFAULT_SCROLLBACK_FINISHED_JOBS)
+
+    self.cache              = self.createCache()
+    self.spools             = SpoolStore(spoolDirname(), DEFAULT_SPOOL_INTERVAL)
+    self.watcher            = None # FileWatcher, created by the first ##_WATCH_
+    self.watchQueue         = [] # ids of the watches due, waiting for a slot
+    self.cacheCaptures      = {} # { id : (key, [lines], size) } output of jobs to cache
+
+    # diagnostics, see profile() and memorySnapshot()
+    self.profiler           = Profiler()
+    self.memory             = MemoryTracker()
+    self.signals            = [] # signals received, handled by poll()
+
+    # persistent mode: nothing is sent to vim until it gives its session
+    self.session            = None
+    self.attached           = not main.persistent
+    self.lastJobId          = 0
+    self.detachPaused       = set() # id of jobs paused while detached
+
+  # createCache(): results of the 'cache' jobs, also kept in main.cacheDir
+  # when given
+  def createCache(self):
+    return ResultCache(DEFAULT_CACHE_SIZE, self.main.cacheDir)
 
   def hasInsert(self, bufId):
     if not self.buffersInserts.has_key(bufId):
@@ -215,22 +647,84 @@ class ProcRunner(NetBeans, Proxy.Handler):
     self.buffersInserts[bufId].reverse()
     return insert
 
-  def pauseVimMessages(self, after=0, procId=0):
+  def pauseVimMessages(self):
     log.debug("ProcRunner.pauseVimMessages: pausing")
-    if after > 0:
-      self.pauseAfter = after
-      self.pauseAfterProcId = procId
-    else:
-      self.isPause = True
+    self.isPause = True
 
+  # continueVimMessages(): also remove credit limits of all jobs
   def continueVimMessages(self):
-    log.debug("ProcRunner.continueVimMessages: continuing")
+    log.debug("ProcRunner.continueVimMessages: continuing (%s)", self.lanes.stats())
     self.isPause = False
 
-    for msg in self.pausedMessages:
-      self.sendToVim(msg)
+    for id in self.credits.keys():
+      self.unlimitCredits(id)
+
+  # grantCredits(): allow the job to send given messages and/or bytes more,
+  # a job without credits is unlimited
+  def grantCredits(self, id, messages=0, bytes=0):
+    if not self.credits.has_key(id):
+      self.credits[id] = Credits()
+
+    credits = self.credits[id]
+    credits.grant(messages, bytes)
+    log.debug("ProcRunner.grantCredits: %d : %s", id, str(credits))
+
+    self.releaseHeldMessages(id)
+
+  def unlimitCredits(self, id):
+    if not self.credits.has_key(id):
+      return
+
+    del self.credits[id]
+    self.releaseHeldMessages(id)
+
+  # releaseHeldMessages(): send what the credits allow, credits of an ended
+  # job are dropped once its output (up to ##_TERMINATED_) is all sent
+  def releaseHeldMessages(self, id):
+    held = self.heldMessages.get(id, [])
+    while len(held) and self.consumeCredits(id, held[0]):
+      self.sendToVim(held.pop(0), id)
+
+    if not len(held):
+      self.heldMessages.pop(id, None)
+      status = self.heldStatus.pop(id, None)
+      if status != None:
+        self.sendToVim(status, id)
+        self.credits.pop(id, None)
+        self.jobLanes.pop(id, None)
+      elif self.processes.has_key(id):
+        self.main.proxy.resumeProc(self.processes[id])
+      self.resumeStages(self.pipelines.get(id, []))
+
+  # isJobOver(): job output and status are known, ##_TERMINATED_ is queued
+  # or held, see heldStatus
+  def isJobOver(self, id):
+    return not (self.processes.has_key(id) or self.endedPids.has_key(id))
+
+  # consumeCredits(): return False when data can't be sent yet
+  def consumeCredits(self, id, data):
+    if not self.credits.has_key(id):
+      return True
+
+    credits = self.credits[id]
+    if credits.isExhausted():
+      return False
+
+    credits.consume(len(data))
+    return True
 
-    self.pausedMessages = []
+  # sendJobOutput(): send output of job id if it has credits left, otherwise
+  # hold it and stop reading from the job. A job without credits is read
+  # until it has output to hold, its end doesn't need credits.
+  def sendJobOutput(self, id, data):
+    if not self.heldMessages.has_key(id) and self.consumeCredits(id, data):
+      self.sendToVim(data, id)
+      return
+
+    self.heldMessages.setdefault(id, []).append(data)
+    if self.processes.has_key(id):
+      log.debug("ProcRunner.sendJobOutput: %d : out of credits", id)
+      self.main.proxy.pauseProc(self.processes[id])
 
   def setupInOutBuffers(self):
     # note: when using create(), buffer ids are killed and reopened by vim
@@ -245,21 +739,338 @@ class ProcRunner(NetBeans, Proxy.Handler):
     # create an empty buffer and thus allow hidding the previous ones
     self.create()
 
-    # throw BufReadPost
+    # throw BufReadPost, acknowledged once vim found the buffers
     self.initDone(self.vimProxyInId)
+    self.notified = True
+
+  # attachSession(): vim (re)connected with given session token.
+  # A different token drops the jobs of the previous session.
+  # ##_ATTACHED_<last job id>_##<job ids> tells vim which jobs it gets back
+  # before their pending messages.
+  def attachSession(self, token):
+    if self.session != None and self.session != token:
+      log.info("ProcRunner.attachSession: new session, dropping previous jobs")
+      self.dropJobs()
+
+    self.session = token
+    self.attached = True
+
+    ids = self.jobIds() | set([id for (id, data) in self.lanes.messages() if id != None])
+    ids = ','.join([str(id) for id in sorted(ids)])
+
+    log.debug("ProcRunner.attachSession: %s : jobs: %s", token, ids)
+    self.lanes.push(LANE_CONTROL, (None, self.protoAttached % (self.lastJobId, ids)), first=True)
+
+    self.resumeDetachedJobs()
+
+  # jobIds(): jobs not terminated yet
+  def jobIds(self):
+    ids = set(self.processes.keys()) | set(self.endedPids.keys()) | set(self.heldMessages.keys())
+    ids |= set([id for (id, cmd, options, due) in self.pendingJobs.values()])
+    return ids - self.droppedJobs
+
+  # dropJobs(): the jobs are cancelled, the new session hears nothing of them
+  def dropJobs(self):
+    for id in self.processes.keys() + self.endedPids.keys():
+      self.droppedJobs.add(id)
+      self.cancelJob(id)
+    self.pendingJobs = {}
+    self.keyedJobs = {}
+    for id in self.heldMessages.keys():
+      if self.isJobOver(id):
+        self.credits.pop(id, None)
+        self.jobLanes.pop(id, None)
+    self.heldMessages = {}
+    self.heldStatus = {}
+    self.lanes = MessageLanes()
+    if self.watcher != None:
+      for id in self.watcher.watches.keys():
+        self.unwatchFiles(id)
+
+  # stopJobs(): the daemon stops, kill the jobs and stages left
+  def stopJobs(self):
+    for id in self.pids.keys() + self.endedPids.keys():
+      log.info("ProcRunner.stopJobs: %d : killing", id)
+      self.killJob(id)
+    for id in self.pipelines.keys():
+      self.stopPipeline(id)
+    if self.watcher != None:
+      self.watcher.close()
+
+  # pauseDetachedJobs(): bound what is kept for vim while it is away
+  def pauseDetachedJobs(self):
+    if len(self.lanes) < DEFAULT_DETACHED_MAX_MESSAGES: return
+
+    for (id, desc) in self.processes.items():
+      if id in self.detachPaused: continue
+      log.debug("ProcRunner.pauseDetachedJobs: %d : paused until vim is back", id)
+      self.detachPaused.add(id)
+      self.main.proxy.pauseProc(desc)
+
+  def resumeDetachedJobs(self):
+    for id in self.detachPaused:
+      if self.processes.has_key(id) and not self.heldMessages.has_key(id):
+        self.main.proxy.resumeProc(self.processes[id])
+    self.detachPaused = set()
+
+  # requestJob(): ##_EXEC_ entry point
+  # A job with a 'key' option supersedes the previous job of the same key:
+  # the pending one is cancelled, the running one is killed and its output
+  # suppressed. With 'debounce' (ms), the job only starts if no newer job
+  # with the same key is requested meanwhile.
+  def requestJob(self, id, cmd, options):
+    self.lastJobId = max(self.lastJobId, id)
+
+    key = options.get('key')
+    if key == None:
+      return self.execJob(id, cmd, options)
+
+    if self.pendingJobs.has_key(key):
+      pendingId = self.pendingJobs.pop(key)[0]
+      log.debug("ProcRunner.requestJob: %d : cancelled before starting", pendingId)
+      self.sendToVim(self.protoCancelled % (pendingId), pendingId)
+
+    if self.keyedJobs.has_key(key):
+      self.cancelJob(self.keyedJobs.pop(key))
+
+    debounce = toInt(options.get('debounce'))
+    if debounce > 0:
+      self.pendingJobs[key] = (id, cmd, options, time.time() + debounce / 1000.0)
+      return True
+
+    if not self.execJob(id, cmd, options): return False
+    if self.processes.has_key(id): self.keyedJobs[key] = id # not over if cached
+    return True
+
+  # jobFailed(): job id could not be started, vim gets ##_TERMINATED_ with
+  # status 255
+  def jobFailed(self, id, cmd):
+    log.error("ProcRunner.jobFailed: %d : unable to start command (%s)", id, cmd)
+    self.sendToVim(self.protoTerminated % (id, 255), id)
+
+  # watchFiles(): ##_WATCH_ entry point, run cmd as job id each time files
+  # matching the 'paths' option change. A watch runs a single job at a time,
+  # changes while it runs start it again once over, and at most
+  # DEFAULT_MAX_WATCH_JOBS watch jobs run at once.
+  def watchFiles(self, id, cmd, options):
+    self.lastJobId = max(self.lastJobId, id)
+
+    if self.watcher == None:
+      try: self.watcher = FileWatcher()
+      except OSError:
+        log.exception("ProcRunner.watchFiles: file watching not available")
+        return False
+      self.main.proxy.addReader(self.watcher.fileno(), self.readWatches)
+
+    cwd = options.get('cwd') or os.getcwd()
+    patterns = [os.path.normpath(os.path.join(cwd, os.path.expanduser(p))) for p in toList(options.get('paths'))]
+    debounce = toInt(options.get('debounce'), DEFAULT_WATCH_DEBOUNCE) / 1000.0
+
+    watch = Watch(id, cmd, options, patterns, toInt(options.get('recursive')) != 0, debounce)
+    return self.watcher.add(watch)
+
+  def unwatchFiles(self, id):
+    if self.watcher == None or self.watcher.remove(id) == None:
+      log.warning("ProcRunner.unwatchFiles: %d : not watching", id)
+      return False
+
+    if id in self.watchQueue: self.watchQueue.remove(id)
+    return True
+
+  def readWatches(self, desc):
+    try: self.watcher.read()
+    except OSError:
+      log.exception("ProcRunner.readWatches: exception")
+    return True
+
+  def startWatchJobs(self):
+    for watch in self.watcher.due(time.time()):
+      watch.due = None
+      if watch.running: watch.rerun = True
+      elif watch.id not in self.watchQueue: self.watchQueue.append(watch.id)
+
+    running = len([w for w in self.watcher.watches.values() if w.running])
+    while len(self.watchQueue) and running < DEFAULT_MAX_WATCH_JOBS:
+      watch = self.watcher.watches.get(self.watchQueue.pop(0))
+      if watch == None: continue
+
+      log.debug("ProcRunner.startWatchJobs: %d : %s", watch.id, watch.cmd)
+      # a cached job is over before execJob() returns, see watchJobEnded()
+      watch.running = True
+      if self.execJob(watch.id, watch.cmd, watch.options): running += 1
+      else:
+        log.error("ProcRunner.startWatchJobs: unable to start command (%s)", watch.cmd)
+        watch.running = False
+
+  def watchJobEnded(self, id):
+    watch = self.watcher.watches.get(id)
+    if watch == None or not watch.running: return
+
+    watch.running = False
+    if watch.rerun:
+      watch.rerun = False
+      watch.due = time.time()
+
+  def startPendingJobs(self):
+    now = time.time()
+    for (key, (id, cmd, options, due)) in self.pendingJobs.items():
+      if due > now: continue
+      del self.pendingJobs[key]
+      if not self.execJob(id, cmd, options):
+        self.jobFailed(id, cmd)
+        continue
+      if self.processes.has_key(id): self.keyedJobs[key] = id # not over if cached
+
+  # cancelJob(): kill a running job without reporting its output anymore,
+  # ##_CANCELLED_<id>_## replaces ##_TERMINATED_
+  # A job not running anymore is reported cancelled right away.
+  def cancelJob(self, id):
+    self.heldMessages.pop(id, None)
+    self.heldStatus.pop(id, None)
+    if self.pids.has_key(id) or self.endedPids.has_key(id):
+      log.debug("ProcRunner.cancelJob: %d : killing", id)
+      self.cancelledJobs.add(id)
+      self.killJob(id)
+      return
+
+    log.debug("ProcRunner.cancelJob: %d : not running", id)
+    self.credits.pop(id, None)
+    self.sendToVim(self.protoCancelled % (id), id)
+    self.jobLanes.pop(id, None)
+
+  # killJob(): the output of a killed job is not cached, it may be truncated.
+  def killJob(self, id, sig=signal.SIGTERM):
+    pid = self.pids.get(id) or self.endedPids.get(id)
+    if pid == None:
+      log.warning("ProcRunner.killJob: %d : not running", id)
+      return False
+
+    self.cacheCaptures.pop(id, None)
+
+    # read the job until its end whatever its credits or vim, so that it is
+    # reaped and reported
+    self.unlimitCredits(id)
+    self.detachPaused.discard(id)
+    if self.processes.has_key(id):
+      self.main.proxy.resumeProc(self.processes[id])
+
+    # forkpty() child is a session leader, kill its whole process group
+    try: os.killpg(pid, sig)
+    except OSError:
+      try: os.kill(pid, sig)
+      except OSError:
+        log.exception("ProcRunner.killJob: exception: ")
+        return False
+    return True
+
+  # execJob(): start cmd as job id with given ##_EXEC_ options,
+  # or replay its output when cached
+  def execJob(self, id, cmd, options):
+    cwd = options.get('cwd') or os.getcwd()
+
+    try: stages = parsePipeline(id, options)
+    except ValueError as e:
+      log.error("ProcRunner.execJob: %d : invalid pipeline: %s", id, str(e))
+      return False
+
+    key = None
+    if toInt(options.get('cache')) != 0:
+      cached = cmd
+      if len(stages): cached += json.dumps([options.get('pipeline'), options.get('inputs')])
+      key = cacheKey(cached, cwd, toList(options.get('cacheEnv')), toList(options.get('cacheInputs')),
+                     toInt(options.get('cacheHash')) != 0)
+
+    self.jobLanes[id] = LANE_BULK
+    if toInt(options.get('interactive')) != 0:
+      self.jobLanes[id] = LANE_INTERACTIVE
+
+    transformer = createTransformer(options)
+    if transformer != None:
+      self.transformers[id] = transformer
+
+    parser = createQuickfixParser(options)
+    if parser != None:
+      batch = toInt(options.get('quickfixBatch'), DEFAULT_QUICKFIX_BATCH)
+      self.quickfix[id] = (parser, max(batch, 1), toInt(options.get('quickfixOnly')) != 0)
+
+    self.scrollback.add(id, toInt(options.get('scrollback')))
+
+    if toInt(options.get('spool')) != 0:
+      self.spools.add(id)
+
+    result = None
+    if key != None:
+      result = self.cache.get(key)
+
+    if result != None:
+      log.debug("ProcRunner.execJob %d : %s replayed from cache", id, cmd)
+      self.grantInitialCredits(id, options)
+      self.sendToVim(self.protoStarted % (id), id)
+      for line in result.lines:
+        self.jobOutput(id, line)
+      self.finishJob(id, result.status)
+      return True
+
+    # stages first: they are only read once the job is started too
+    if len(stages) and not self.startPipeline(id, stages, cwd):
+      log.error("ProcRunner.execJob: %d : unable to start the pipeline", id)
+      stages = None
+
+    stdinPipe = toInt(options.get('stdinPipe')) != 0 or self.feeders.has_key(id)
+    if stages == None or not self.startProc(id, cmd, cwd, toInt(options.get('progressInterval')), stdinPipe,
+                                            toInt(options.get('partialDelay'))):
+      self.stopPipeline(id)
+      self.transformers.pop(id, None)
+      self.quickfix.pop(id, None)
+      self.jobLanes.pop(id, None)
+      self.scrollback.remove(id)
+      self.spools.remove(id)
+      return False
+
+    if key != None:
+      self.cacheCaptures[id] = (key, [], 0)
+
+    self.grantInitialCredits(id, options)
 
-  def startProc(self, id, cmd):
+    size = toInt(options.get('stdinQueue'), DEFAULT_STDIN_QUEUE_SIZE)
+    self.stdinQueues[id] = WriteQueue(size, max(size * 8, DEFAULT_STDIN_QUEUE_LIMIT))
+
+    self.sendToVim(self.protoStarted % (id), id)
+    return True
+
+  # grantInitialCredits(): 'credits' and 'creditBytes' ##_EXEC_ options,
+  # once the job output can come
+  def grantInitialCredits(self, id, options):
+    messages = toInt(options.get('credits'))
+    bytes = toInt(options.get('creditBytes'))
+    if messages > 0 or bytes > 0:
+      self.grantCredits(id, messages, bytes)
+
+  # startProc(): run cmd in a pty, with a pipe as stdin if stdinPipe so
+  # that it can be closed (see closeStdin())
+  def startProc(self, id, cmd, cwd=None, progressInterval=0, stdinPipe=False, partialDelay=0):
+    pipe = None
     try:
+      if stdinPipe: pipe = os.pipe()
       (pid, fd) = os.forkpty()
     except Exception as e:
       log.exception("ProcRunner.startProc: exception while forkpty(): ")
+      if pipe != None:
+        os.close(pipe[0])
+        os.close(pipe[1])
       return False
 
     sh = '/bin/sh'
 
     if pid == 0:
       # child
-      try: os.execlp(sh, sh, '-c', cmd)
+      try:
+        if pipe != None:
+          os.dup2(pipe[0], 0)
+          os.close(pipe[0])
+          os.close(pipe[1])
+        if cwd: os.chdir(cwd)
+        os.execlp(sh, sh, '-c', cmd)
       except Exception as e:
         log.error("ProcRunner.startProc: exception: %s", str(e))
       os._exit(1)
@@ -273,13 +1084,212 @@ class ProcRunner(NetBeans, Proxy.Handler):
     # b) prevents size limitation while sending data to child processes
     tty.setraw(fd)
 
+    # job stdin is written as the job reads it, see writeStdin()
+    setNonBlocking(fd)
+
+    if pipe != None:
+      os.close(pipe[0])
+      setNonBlocking(pipe[1])
+      setCloseOnExec(pipe[1])
+      self.stdinPipes[id] = pipe[1]
+      self.invStdinPipes[pipe[1]] = id
+
     self.processes[id] = fd
     self.invProcesses[fd] = id
-    self.main.proxy.addProc(fd)
+    self.pids[id] = pid
+    self.main.proxy.addProc(fd, progressInterval, partialDelay)
 
     log.debug("ProcRunner.startProc %d : %s started", id, cmd)
     return True
 
+  # startPipeline(): start the stages of job id (see parsePipeline()),
+  # stages with inputs get a stdin queue as jobs do, with a negative id
+  def startPipeline(self, id, stages, cwd):
+    for stage in stages:
+      if len(stage.inputs):
+        self.lastStageId -= 1
+        stage.id = self.lastStageId
+      for upstream in stage.inputs:
+        upstream.outputs.append(stage.id)
+
+    self.pipelines[id] = []
+    for stage in stages:
+      if not self.startStage(stage, cwd): return False
+      self.pipelines[id].append(stage)
+      for out in stage.outputs:
+        self.feeders.setdefault(out, []).append(stage)
+    return True
+
+  # startStage(): run a stage with its stdout and stderr on a pipe read by
+  # readStage(), its stdin is a pipe when it has inputs, /dev/null otherwise
+  def startStage(self, stage, cwd):
+    pipes = []
+    try:
+      output = os.pipe()
+      pipes.append(output)
+      if stage.id != None: pipes.append(os.pipe())
+      for (r, w) in pipes:
+        setCloseOnExec(r)
+        setCloseOnExec(w)
+      pid = os.fork()
+    except OSError:
+      log.exception("ProcRunner.startStage: %d : exception while starting stage %d: ", stage.jobId, stage.index)
+      for (r, w) in pipes:
+        os.close(r)
+        os.close(w)
+      return False
+
+    sh = '/bin/sh'
+
+    if pid == 0:
+      # child, in its own process group as jobs are
+      try:
+        os.setsid()
+        if stage.id != None: os.dup2(pipes[1][0], 0)
+        else: os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+        os.dup2(output[1], 1)
+        os.dup2(output[1], 2)
+        # the daemon ignores SIGPIPE, a stage must end when its reader did
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        if cwd: os.chdir(cwd)
+        os.execlp(sh, sh, '-c', stage.cmd)
+      except Exception as e:
+        log.error("ProcRunner.startStage: exception: %s", str(e))
+      os._exit(1)
+
+    stage.pid = pid
+    stage.desc = output[0]
+    os.close(output[1])
+    setNonBlocking(stage.desc)
+    self.stageDescs[stage.desc] = stage
+    self.main.proxy.addReader(stage.desc, self.readStage)
+
+    if stage.id != None:
+      (r, w) = pipes[1]
+      os.close(r)
+      setNonBlocking(w)
+      self.stdinPipes[stage.id] = w
+      self.invStdinPipes[w] = stage.id
+      self.stdinQueues[stage.id] = WriteQueue(DEFAULT_STDIN_QUEUE_SIZE, DEFAULT_STDIN_QUEUE_LIMIT)
+
+    log.debug("ProcRunner.startStage %d : stage %d : %s started", stage.jobId, stage.index, stage.cmd)
+    return True
+
+  # stopPipeline(): the job is over or didn't start, its stages are killed
+  # and their remaining output dropped
+  def stopPipeline(self, id):
+    stages = self.pipelines.get(id, [])
+    for stage in stages:
+      for out in stage.outputs:
+        feeders = self.feeders.get(out, [])
+        if stage in feeders: feeders.remove(stage)
+        if not len(feeders): self.feeders.pop(out, None)
+      stage.outputs = []
+      stage.tap = False
+
+      if stage.desc in self.stageDescs:
+        try: os.killpg(stage.pid, signal.SIGTERM)
+        except OSError: pass
+
+    # read until their end to reap them
+    self.resumeStages(stages)
+
+  # readStage(): a stage output is spliced to the stdin of its outputs by
+  # whole lines, so that the lines of several stages read by the same
+  # process are not mixed
+  def readStage(self, desc):
+    stage = self.stageDescs[desc]
+    try: data = os.read(desc, STAGE_READ_SIZE)
+    except OSError as e:
+      if e.errno in [errno.EAGAIN, errno.EINTR]: return True
+      log.exception("ProcRunner.readStage: exception")
+      data = ''
+
+    if not len(data):
+      self.stageEnded(stage)
+      return True
+
+    self.spliceStage(stage, stage.splice(data))
+    return True
+
+  def spliceStage(self, stage, data):
+    if not len(data): return
+
+    for out in stage.outputs:
+      queue = self.stdinQueues.get(out)
+      if queue == None or queue.eof: continue # output over
+      if not queue.push(data):
+        log.error("ProcRunner.spliceStage: %d : stdin queue full, %d bytes dropped", out, len(data))
+        continue
+      self.writeStdin(out)
+
+    if stage.tap:
+      for line in data.split("\n"):
+        line = line.strip()
+        if len(line): self.sendJobOutput(stage.jobId, self.protoTap % (stage.jobId, stage.index, line))
+
+    if self.isStageBlocked(stage):
+      stage.paused = True
+      self.main.proxy.removeReader(stage.desc)
+
+  # isStageBlocked(): a stage isn't read while one of its outputs is full or
+  # while its job is out of credits for the tapped output
+  def isStageBlocked(self, stage):
+    for out in stage.outputs:
+      queue = self.stdinQueues.get(out)
+      if queue != None and queue.isFull(): return True
+    return stage.tap and self.heldMessages.has_key(stage.jobId)
+
+  def resumeStages(self, stages):
+    for stage in stages:
+      if stage.paused and stage.desc in self.stageDescs and not self.isStageBlocked(stage):
+        stage.paused = False
+        self.main.proxy.addReader(stage.desc, self.readStage)
+
+  # stageEnded(): stage output is closed, so are the stdin fed only by it
+  def stageEnded(self, stage):
+    self.spliceStage(stage, stage.splice('', eof=True))
+
+    self.main.proxy.removeReader(stage.desc)
+    del self.stageDescs[stage.desc]
+    try: os.close(stage.desc)
+    except OSError: log.exception("ProcRunner.stageEnded: exception while closing: ")
+
+    if stage.id != None:
+      # its input isn't read anymore
+      queue = self.stdinQueues.pop(stage.id, None)
+      if queue != None: queue.close()
+      self.closeStdinPipe(stage.id)
+      self.resumeStages(self.feeders.pop(stage.id, []))
+
+    for out in stage.outputs:
+      feeders = self.feeders.get(out, [])
+      if stage in feeders: feeders.remove(stage)
+      if len(feeders): continue
+
+      self.feeders.pop(out, None)
+      queue = self.stdinQueues.get(out)
+      if queue != None and not queue.eof: self.closeStdin(out)
+
+    self.endedStages.append(stage)
+    self.reapStages()
+
+  def reapStages(self):
+    for stage in list(self.endedStages):
+      try: (p, status) = os.waitpid(stage.pid, os.WNOHANG)
+      except OSError:
+        log.exception("ProcRunner.reapStages: exception while waiting: ")
+        (p, status) = (stage.pid, -1)
+
+      if p == 0: continue # still running
+
+      self.endedStages.remove(stage)
+      stages = self.pipelines.get(stage.jobId, [])
+      if stage in stages: stages.remove(stage)
+      if not len(stages): self.pipelines.pop(stage.jobId, None)
+
+      log.debug("ProcRunner.reapStages: %d : stage %d terminated (%d)", stage.jobId, stage.index, status)
+
   def writeRawToVim(self, data):
     log.debug("Main.writeRawToVim: data: '%s'", data.strip())
     try: self.vimSocket.sendall(data)
@@ -288,19 +1298,137 @@ class ProcRunner(NetBeans, Proxy.Handler):
       return False
     return True
 
+  # writeRawToProc(): queue data for the job stdin, written once the job
+  # reads it without blocking the daemon
   def writeRawToProc(self, id, data):
     log.debug("ProcRunner.writeRawToProc: data: '%s'", data.strip())
-    if data[-1:] != "\\n": data += "\n"
+    if data[-1:] != "\n": data += "\n"
 
-    try:
-      desc = self.processes[id]
-      os.write(desc, data)
-    except Exception as e:
-      log.exception("ProcRunner.writeRawToProc: exception: ")
+    queue = self.stdinQueues.get(id)
+    if queue == None or queue.eof:
+      log.warning("ProcRunner.writeRawToProc: %d : not running or stdin closed", id)
+      return False
+
+    if not queue.push(data):
+      log.error("ProcRunner.writeRawToProc: %d : stdin queue full, %d bytes dropped", id, len(data))
+      return False
+
+    return self.writeStdin(id)
+
+  # feedFile(): queue the content of a file for the job stdin, unlinked
+  # once open or rejected when remove (temporary file written by vim)
+  def feedFile(self, id, path, remove=False):
+    queue = self.stdinQueues.get(id)
+    if queue == None or queue.eof:
+      log.warning("ProcRunner.feedFile: %d : not running or stdin closed", id)
+      if remove: self.removeFeed(path)
+      return False
+
+    try: f = open(path, 'rb')
+    except IOError:
+      log.exception("ProcRunner.feedFile: %d : unable to feed %s", id, path)
+      if remove: self.removeFeed(path)
+      return False
+
+    # the open file is read whatever happens to its name
+    if remove: self.removeFeed(path)
+
+    queue.pushFile(f)
+    return self.writeStdin(id)
+
+  # removeFeed(): temporary file vim gave to feedFile(), read or rejected
+  def removeFeed(self, path):
+    try: os.remove(path)
+    except OSError:
+      log.exception("ProcRunner.removeFeed: unable to remove %s", path)
+
+  # closeStdin(): end of the job input once its queue is written, only for
+  # a stdin pipe: a pty can't be half closed and a job already blocked
+  # reading it in raw mode doesn't see the EOF character
+  def closeStdin(self, id):
+    queue = self.stdinQueues.get(id)
+    if queue == None or queue.eof:
+      log.warning("ProcRunner.closeStdin: %d : not running or stdin closed", id)
+      return False
+
+    if not self.stdinPipes.has_key(id):
+      log.warning("ProcRunner.closeStdin: %d : stdin is a pty, see the stdinPipe option", id)
       return False
+
+    queue.eof = True
+    return self.writeStdin(id)
+
+  def closeStdinPipe(self, id):
+    desc = self.stdinPipes.pop(id, None)
+    if desc == None: return
+
+    del self.invStdinPipes[desc]
+    self.main.proxy.wantWrite(desc, False)
+    try: os.close(desc)
+    except OSError: log.exception("ProcRunner.closeStdinPipe: exception while closing: ")
+
+  # writeStdin(): write what the job stdin accepts, the rest when the proxy
+  # finds it writable. Vim is told to stop writing while the queue is full.
+  def writeStdin(self, id):
+    queue = self.stdinQueues[id]
+    desc = self.stdinPipes.get(id)
+    if desc == None: desc = self.processes[id]
+
+    try: queue.write(desc)
+    except OSError:
+      log.exception("ProcRunner.writeStdin: %d : exception: ", id)
+      self.stdinQueues.pop(id).close()
+      self.main.proxy.wantWrite(desc, False)
+      self.closeStdinPipe(id)
+      self.resumeStages(self.feeders.get(id, []))
+      return False
+
+    self.main.proxy.wantWrite(desc, not queue.isEmpty())
+
+    if queue.isEmpty() and queue.eof:
+      self.closeStdinPipe(id)
+      del self.stdinQueues[id]
+
+    # stdin fed by stages: they are paused instead, see spliceStage()
+    if queue.isFull() and not queue.full:
+      queue.full = True
+      if not self.feeders.has_key(id): self.sendToVim(self.protoStdinFull % (id))
+    elif queue.full and queue.isLow():
+      queue.full = False
+      if self.feeders.has_key(id): self.resumeStages(self.feeders[id])
+      else: self.sendToVim(self.protoStdinReady % (id))
     return True
 
+  def procWritable(self, desc):
+    id = self.invStdinPipes.get(desc, self.invProcesses.get(desc))
+    if id == None or not self.stdinQueues.has_key(id):
+      self.main.proxy.wantWrite(desc, False)
+      return 0
+    queue = self.stdinQueues[id]
+    size = queue.size
+    self.writeStdin(id)
+    return size - queue.size
+
+  # fromVim(): a NetBeans client starts with AUTH, a channel client with
+  # a protocol message (##_AUTH_ from abeans#start()). Nothing else is
+  # handled until vim gave the daemon secret this way.
   def fromVim(self, data):
+    if self.transport == None:
+      self.transport = TRANSPORT_NETBEANS
+      if data.startswith('##_'): self.transport = TRANSPORT_CHANNEL
+      log.info("ProcRunner.fromVim: vim uses the %s transport", self.transport)
+
+    if not self.authenticated:
+      self.authenticated = self.checkSecret(data)
+      if not self.authenticated:
+        log.warning("ProcRunner.fromVim: wrong secret, refusing vim")
+        self.main.proxy.refuseVim()
+      return
+
+    if self.transport == TRANSPORT_CHANNEL:
+      self.command(data)
+      return
+
     self.process(data)
 
     data = self.getLastInsert(self.vimProxyOutId)
@@ -309,63 +1437,177 @@ class ProcRunner(NetBeans, Proxy.Handler):
     if data == None:
       return
 
+    self.command(data)
+
+  # checkSecret(): 'AUTH <secret>' sent by :nbstart, ##_AUTH_<secret>_## on a
+  # channel
+  def checkSecret(self, data):
+    if self.transport == TRANSPORT_CHANNEL:
+      m = self.reProtoAuthCmd.match(data)
+    else:
+      m = self.reNetBeansAuth.match(data)
+    return m != None and hmac.compare_digest(m.group(1), self.main.secret)
+
+  # command(): handle a protocol line sent by vim
+  def command(self, data):
     def execCmd(m):
       try:
         id = int(m.group(1))
         cmd = m.group(2)
+        options = {}
+        if m.group(3) != None:
+          options = json.loads(m.group(3))
       except:
-        log.exception("ProcRunner.fromVim.execCmd: exception")
+        log.exception("ProcRunner.command.execCmd: exception")
         return False
     
-      if not self.startProc(id, cmd):
-        log.error("ProcRunner.fromVim.execCmd: unable to start command (%s)", cmd)
+      if not self.requestJob(id, cmd, options):
+        self.jobFailed(id, cmd)
         return False
 
-      self.sendToVim(self.protoStarted % (id))
       return True
 
     def killCmd(m):
-      log.warning("ProcRunner.fromVim.killCmd: TO IMPLEMENT")
-      return False
+      try: id = int(m.group(1))
+      except:
+        log.exception("ProcRunner.command.killCmd: exception")
+        return False
+
+      return self.killJob(id)
 
     def dataCmd(m):
       try:
         id = int(m.group(1))
         data = m.group(2)
       except:
-        log.exception("ProcRunner.fromVim.dataCmd: exception")
+        log.exception("ProcRunner.command.dataCmd: exception")
         return False
 
       self.writeRawToProc(id, data)
       return True
 
-    def dataAndPauseCmd(m):
+    def feedCmd(m):
       try:
         id = int(m.group(1))
-        pauseAfter = int(m.group(2))
-        data = m.group(3)
+        remove = m.group(2) == '1'
+        path = m.group(3)
       except:
-        log.exception("ProcRunner.fromVim.dataCmd: exception")
+        log.exception("ProcRunner.command.feedCmd: exception")
         return False
 
-      self.pauseVimMessages(after=pauseAfter, procId=id)
+      return self.feedFile(id, path, remove)
 
-      self.writeRawToProc(id, data)
+    def eofCmd(m):
+      try: id = int(m.group(1))
+      except:
+        log.exception("ProcRunner.command.eofCmd: exception")
+        return False
+
+      return self.closeStdin(id)
+
+    def creditCmd(m):
+      try:
+        id = int(m.group(1))
+        messages = int(m.group(2))
+        bytes = int(m.group(3))
+      except:
+        log.exception("ProcRunner.command.creditCmd: exception")
+        return False
+
+      self.grantCredits(id, messages, bytes)
+      return True
+
+    def unlimitedCmd(m):
+      try: id = int(m.group(1))
+      except:
+        log.exception("ProcRunner.command.unlimitedCmd: exception")
+        return False
+
+      self.unlimitCredits(id)
+      return True
+
+    def fetchLinesCmd(m):
+      try:
+        id = int(m.group(1))
+        start = int(m.group(2))
+        count = int(m.group(3))
+      except:
+        log.exception("ProcRunner.command.fetchLinesCmd: exception")
+        return False
+
+      self.fetchLines(id, start, count)
+      return True
+
+    def fetchBytesCmd(m):
+      try:
+        id = int(m.group(1))
+        offset = int(m.group(2))
+        length = int(m.group(3))
+      except:
+        log.exception("ProcRunner.command.fetchBytesCmd: exception")
+        return False
+
+      self.fetchBytes(id, offset, length)
+      return True
+
+    def sessionCmd(m):
+      self.attachSession(m.group(1))
       return True
 
     def pauseCmd(m):
-      self.pauseVimMessages(after=0)
+      self.pauseVimMessages()
 
     def continueCmd(m):
       self.continueVimMessages()
 
+    def ackCmd(m):
+      self.acknowledge(int(m.group(1)))
+
+    def watchCmd(m):
+      try:
+        id = int(m.group(1))
+        cmd = m.group(2)
+        options = json.loads(m.group(3))
+      except:
+        log.exception("ProcRunner.command.watchCmd: exception")
+        return False
+
+      if not self.watchFiles(id, cmd, options):
+        log.error("ProcRunner.command.watchCmd: unable to watch for command (%s)", cmd)
+        return False
+      return True
+
+    def unwatchCmd(m):
+      return self.unwatchFiles(int(m.group(1)))
+
+    def profileCmd(m):
+      self.profile(int(m.group(1)))
+
+    def memoryCmd(m):
+      self.memorySnapshot()
+
+    def watchdogCmd(m):
+      self.main.proxy.setWatchdog(int(m.group(1)))
+
     regexps = [
       (self.reProtoExecCmd, execCmd),
       (self.reProtoKillCmd, killCmd),
       (self.reProtoDataCmd, dataCmd),
-      (self.reProtoDataAndPauseCmd, dataAndPauseCmd),
+      (self.reProtoFeedCmd, feedCmd),
+      (self.reProtoEofCmd, eofCmd),
+      (self.reProtoCreditCmd, creditCmd),
+      (self.reProtoUnlimitedCmd, unlimitedCmd),
+      (self.reProtoFetchLinesCmd, fetchLinesCmd),
+      (self.reProtoFetchBytesCmd, fetchBytesCmd),
+      (self.reProtoSessionCmd, sessionCmd),
       (self.reProtoPauseCmd, pauseCmd),
-      (self.reProtoContinueCmd, continueCmd)
+      (self.reProtoContinueCmd, continueCmd),
+      (self.reProtoAckCmd, ackCmd),
+      (self.reProtoWatchCmd, watchCmd),
+      (self.reProtoUnwatchCmd, unwatchCmd),
+      (self.reProtoProfileCmd, profileCmd),
+      (self.reProtoMemoryCmd, memoryCmd),
+      (self.reProtoWatchdogCmd, watchdogCmd)
     ]
 
     for (r, cb) in regexps:
@@ -374,23 +1616,331 @@ class ProcRunner(NetBeans, Proxy.Handler):
       cb(m)
       return
 
-    log.error("ProcRunner.fromVim: data out of protocol: '%s'", data)
+    log.error("ProcRunner.command: data out of protocol: '%s'", data)
 
   def fromProc(self, desc, data):
+    self.jobOutput(self.invProcesses[desc], data)
+
+  # jobOutput(): a line output by job id, read from the job or its cache.
+  # The errorformat sees the line indented, vim gets it stripped.
+  def jobOutput(self, id, data):
+    if id in self.cancelledJobs: return
+
+    self.scrollback.append(id, data.lstrip())
+
+    if self.cacheCaptures.has_key(id):
+      (key, lines, size) = self.cacheCaptures[id]
+      size += len(data) + 1
+      if size > self.cache.maxBytes:
+        log.debug("ProcRunner.jobOutput: %d : too large to be cached", id)
+        del self.cacheCaptures[id]
+      else:
+        lines.append(data)
+        self.cacheCaptures[id] = (key, lines, size)
+
+    if self.transformers.has_key(id):
+      data = self.transformers[id].apply(data)
+      if data == None: return
+
+    if self.quickfix.has_key(id):
+      (parser, batch, quickfixOnly) = self.quickfix[id]
+      self.addQuickfixRecords(id, parser.feed(data), batch)
+      if quickfixOnly: return
+
+    data = data.lstrip()
+    if not len(data): return
+
+    if self.spools.has(id):
+      self.spools.append(id, data)
+      return
+
+    log.debug("ProcRunner.jobOutput: %d : %s" % (id, data))
+    self.sendJobOutput(id, self.protoData % (id, data))
+
+  # flushSpools(): tell vim about the output spooled since the last notice,
+  # one ##_SPOOL_ per job and DEFAULT_SPOOL_INTERVAL at most
+  def flushSpools(self, id=None):
+    for (id, path, offset, length) in self.spools.pending(id):
+      self.sendJobOutput(id, self.protoSpool % (id, offset, length, path))
+
+  # addQuickfixRecords(): records are sent by batches, full ones right away,
+  # others at the end of the proxy loop iteration, see poll()
+  def addQuickfixRecords(self, id, records, batch):
+    if not len(records): return
+
+    pending = self.quickfixBatches.setdefault(id, [])
+    pending.extend(records)
+    while len(pending) >= batch:
+      self.sendQuickfix(id, pending[:batch])
+      del pending[:batch]
+
+  def flushQuickfix(self):
+    for (id, records) in self.quickfixBatches.items():
+      if len(records): self.sendQuickfix(id, records)
+    self.quickfixBatches = {}
+
+  def sendQuickfix(self, id, records):
+    # latin-1 maps each byte to a char: any output survives json
+    for record in records:
+      for (key, value) in record.items():
+        if isinstance(value, str): record[key] = value.decode('latin-1')
+    self.sendJobOutput(id, self.protoQuickfix % (id, json.dumps(records)))
+
+  def fromProcProgress(self, desc, data):
     id = self.invProcesses[desc]
 
-    log.debug("ProcRunner.fromProc: %d : %s" % (id, data))
-    self.sendToVim(self.protoData % (id, data))
+    if self.transformers.has_key(id):
+      data = self.transformers[id].apply(data)
+      if data == None: return
 
-    if self.pauseAfter > 0 and self.pauseAfterProcId == id:
-      self.pauseAfter -= 1
-      if self.pauseAfter == 0:
-        self.isPause = True
+    log.debug("ProcRunner.fromProcProgress: %d : %s" % (id, data))
+    self.sendJobOutput(id, self.protoProgress % (id, data))
 
-  def sendToVim(self, data):
-    if self.isPause:
-      self.pausedMessages.append(data)
-      return True
+  # fromProcPartial(): prompt or line not terminated yet, see partialDelay
+  def fromProcPartial(self, desc, data):
+    id = self.invProcesses[desc]
+
+    if self.transformers.has_key(id):
+      data = self.transformers[id].apply(data)
+      if data == None: return
+
+    log.debug("ProcRunner.fromProcPartial: %d : %s" % (id, data))
+    self.sendJobOutput(id, self.protoPartial % (id, data))
+
+  # procEnded(): job output is closed, the job terminates once reaped
+  def procEnded(self, desc):
+    id = self.invProcesses.pop(desc)
+    del self.processes[id]
+    queue = self.stdinQueues.pop(id, None)
+    if queue != None: queue.close()
+    self.closeStdinPipe(id)
+    self.endedPids[id] = self.pids.pop(id)
+
+    try: os.close(desc)
+    except: log.exception("ProcRunner.procEnded: exception while closing: ")
+
+    self.reapJobs()
+
+  def poll(self):
+    if len(self.signals):
+      self.handleSignals()
+    if self.profiler.isRunning():
+      self.profiler.poll(time.time())
+    if len(self.quickfixBatches):
+      self.flushQuickfix()
+    if len(self.spools.jobs):
+      self.flushSpools()
+    if not self.attached:
+      self.pauseDetachedJobs()
+    if len(self.endedPids):
+      self.reapJobs()
+    if len(self.endedStages):
+      self.reapStages()
+    if len(self.pendingJobs):
+      self.startPendingJobs()
+    if self.watcher != None:
+      self.startWatchJobs()
+
+  def nextPoll(self):
+    due = [due for (id, cmd, options, due) in self.pendingJobs.values()]
+    if len(self.spools.jobs):
+      due.append(self.spools.nextDue())
+    if self.watcher != None:
+      due.append(self.watcher.nextDue())
+    due.append(self.profiler.end)
+    due = [d for d in due if d != None]
+    if not len(due): return None
+    return min(due)
+
+  # profile(): profile the daemon for duration (sec), or stop profiling now
+  # when 0, see Profiler
+  def profile(self, duration):
+    if duration > 0: self.profiler.start(duration)
+    else: self.profiler.stop()
+
+  # memorySnapshot(): log the objects and queues of the daemon, and how they
+  # changed since the previous snapshot
+  def memorySnapshot(self):
+    sizes = {
+      'messages to vim': len(self.lanes),
+      'held messages': sum([len(held) for held in self.heldMessages.values()]),
+      'vim inserts': sum([len(inserts) for inserts in self.buffersInserts.values()]),
+      'stdin bytes': sum([queue.size for queue in self.stdinQueues.values()]),
+      'scrollback bytes': self.scrollback.total,
+      'jobs': len(self.processes),
+      'quickfix records': sum([len(records) for records in self.quickfixBatches.values()])
+    }
+    self.memory.snapshot(sizes)
+
+  # onSignal(): signal handler, see Main.installSignals()
+  def onSignal(self, signum, frame):
+    self.signals.append(signum)
+
+  # handleSignals(): SIGUSR1 toggles profiling, SIGUSR2 takes a memory snapshot
+  def handleSignals(self):
+    (signals, self.signals) = (self.signals, [])
+    for signum in signals:
+      if signum == signal.SIGUSR1: self.profiler.toggle()
+      elif signum == signal.SIGUSR2: self.memorySnapshot()
+
+  # describe(): descriptor name for the watchdog logs
+  def describe(self, desc):
+    if desc == self.vimSocket: return 'vim'
+    if self.invProcesses.has_key(desc): return 'job %d' % (self.invProcesses[desc])
+    if self.stageDescs.has_key(desc): return 'job %d stage %d' % (self.stageDescs[desc].jobId, self.stageDescs[desc].index)
+    if self.invStdinPipes.has_key(desc): return 'stdin of %d' % (self.invStdinPipes[desc])
+    return str(desc)
+
+  def reapJobs(self):
+    for (id, pid) in self.endedPids.items():
+      try: (p, status) = os.waitpid(pid, os.WNOHANG)
+      except OSError:
+        log.exception("ProcRunner.reapJobs: exception while waiting: ")
+        (p, status) = (pid, -1)
+
+      if p == 0: continue # still running
+
+      del self.endedPids[id]
+
+      if os.WIFSIGNALED(status): status = 128 + os.WTERMSIG(status)
+      elif os.WIFEXITED(status): status = os.WEXITSTATUS(status)
+      self.finishJob(id, status)
+
+  def finishJob(self, id, status):
+    log.debug("ProcRunner.finishJob %d : terminated (%d)", id, status)
+
+    self.transformers.pop(id, None)
+    self.scrollback.finish(id)
+
+    if self.pipelines.has_key(id):
+      self.stopPipeline(id)
+
+    if self.quickfix.has_key(id):
+      (parser, batch, quickfixOnly) = self.quickfix.pop(id)
+      if id not in self.cancelledJobs:
+        self.addQuickfixRecords(id, parser.finish(), batch)
+        records = self.quickfixBatches.pop(id, [])
+        if len(records): self.sendQuickfix(id, records)
+      self.quickfixBatches.pop(id, None)
+
+    for (key, keyId) in self.keyedJobs.items():
+      if keyId == id: del self.keyedJobs[key]
+
+    if self.watcher != None:
+      self.watchJobEnded(id)
+
+    if id in self.cancelledJobs:
+      self.spools.remove(id)
+      self.cancelledJobs.discard(id)
+      self.cacheCaptures.pop(id, None)
+      self.credits.pop(id, None)
+      self.sendToVim(self.protoCancelled % (id), id)
+      self.jobLanes.pop(id, None)
+      self.droppedJobs.discard(id)
+      return
+
+    # a job ended by a signal is not a result to replay
+    if self.cacheCaptures.has_key(id):
+      (key, lines, size) = self.cacheCaptures.pop(id)
+      if 0 <= status < 128: self.cache.put(key, status, lines)
+
+    if self.spools.has(id):
+      self.flushSpools(id)
+      self.spools.finish(id)
+
+    # after the job output, including output held by credits, the lane is
+    # kept until the last message is queued. The status costs no credit.
+    if self.heldMessages.has_key(id):
+      self.heldStatus[id] = self.protoTerminated % (id, status)
+      return
+    self.sendToVim(self.protoTerminated % (id, status), id)
+    self.credits.pop(id, None)
+    self.jobLanes.pop(id, None)
+
+  # fetchLines(): send scrollback lines [start, start + count[ of the job,
+  # then ##_FETCHED_<id>_<first line sent>_<total nb lines>_##
+  def fetchLines(self, id, start, count):
+    job = self.scrollback.get(id)
+    if job == None:
+      log.warning("ProcRunner.fetchLines: no scrollback for %d", id)
+      self.sendToVim(self.protoFetched % (id, start, 0), id)
+      return
+
+    (first, lines) = job.getLines(start, count)
+    for line in lines:
+      self.sendToVim(self.protoLine % (id, line), id)
+    self.sendToVim(self.protoFetched % (id, first, job.lineCount()), id)
+
+  # fetchBytes(): send scrollback bytes [offset, offset + length[ of the job
+  # escaped in a single ##_BYTES_<id>_<first offset sent>_<total nb bytes>_##
+  def fetchBytes(self, id, offset, length):
+    job = self.scrollback.get(id)
+    if job == None:
+      log.warning("ProcRunner.fetchBytes: no scrollback for %d", id)
+      self.sendToVim(self.protoBytes % (id, offset, 0, ''), id)
+      return
+
+    (first, data) = job.getBytes(offset, length)
+    self.sendToVim(self.protoBytes % (id, first, job.byteCount(), escapeNetBeans(data)), id)
+
+  # sendToVim(): queue data in the lane of the job id, or the control lane,
+  # messages are really sent by flush(). Jobs dropped with a previous
+  # session send nothing.
+  def sendToVim(self, data, id=None):
+    if id in self.droppedJobs: return True
+    lane = LANE_CONTROL
+    if id != None:
+      lane = self.jobLanes.get(id, LANE_BULK)
+    self.lanes.push(lane, (id, data))
+    return True
+
+  def hasPending(self):
+    return not self.isPause and self.attached and len(self.lanes) > 0
+
+  # flush(): send at most maxBurst messages, higher lanes first, so that
+  # a large backlog doesn't block the proxy loop.
+  # Messages are appended to the .in buffer, and initDone() triggers
+  # abeans#processInput() only once vim acknowledged the previous one
+  # (##_ACK_<nb messages read>_##): a burst costs a single buffer switch.
+  def flush(self):
+    if self.transport == TRANSPORT_CHANNEL:
+      self.flushChannel()
+      return
+
+    n = 0
+    self.hold() # the whole burst in a single send()
+    while n < self.maxBurst and not self.isPause and self.attached:
+      msg = self.lanes.pop()
+      if msg == None: break
+      (id, data) = msg
+      if n == 0: self.startAtomic()
+      self.writeMessage(data)
+      n += 1
+
+    if n > 0:
+      self.inserted += n
+      self.notifyVim()
+      self.endAtomic()
+    self.release()
+
+  # flushChannel(): flush() over a vim channel, messages are lines given to
+  # the channel callback as they come: no buffer, no notification
+  def flushChannel(self):
+    out = []
+    while len(out) < self.maxBurst and not self.isPause and self.attached:
+      msg = self.lanes.pop()
+      if msg == None: break
+      out.append(self.channelLine(msg[1]) + "\n")
+
+    if len(out):
+      self.writeRawToVim(''.join(out))
+
+  def channelLine(self, data):
+    return data.strip()
+
+  # notifyVim(): have vim read the messages inserted and not acknowledged
+  def notifyVim(self):
+    if self.notified or self.acked >= self.inserted: return
 
     # NOTE: 
     # when vim receive insert() and initDone(), it set the buffer as visible,
@@ -400,10 +1950,24 @@ class ProcRunner(NetBeans, Proxy.Handler):
     # b) autocmd vim's events to keep track of the current buffer and then set the buffer
 
     # b)
-    self.startAtomic()
-    self.insert(self.vimProxyInId, 99999, data.strip())
     self.initDone(self.vimProxyInId)
-    self.endAtomic()
+    self.notified = True
+
+  # acknowledge(): vim read the .in buffer, messages inserted meanwhile need
+  # a new notification
+  def acknowledge(self, count):
+    self.acked = min(self.acked + count, self.inserted)
+    self.notified = False
+
+    if self.acked < self.inserted and self.attached:
+      self.hold()
+      self.startAtomic()
+      self.notifyVim()
+      self.endAtomic()
+      self.release()
+
+  def writeMessage(self, data):
+    self.insert(self.vimProxyInId, 99999, data.strip())
 
     # a)
     #def cb(bufId, lnum, column, offset):
@@ -437,10 +2001,32 @@ class ProcRunner(NetBeans, Proxy.Handler):
 
     self.setupInOutBuffers()
 
+  # onDisconnect(): in persistent mode, the proxy detaches vim once its
+  # socket is closed, see vimDisconnected()
   def onDisconnect(self):
     NetBeans.onDisconnect(self)
 
-    self.main.proxy.stop()
+    if not self.main.persistent:
+      self.main.proxy.stop()
+
+  def vimConnected(self, desc):
+    # new NetBeans session, buffers are setup again on startupDone
+    NetBeans.__init__(self)
+    self.vimSocket = desc
+    self.buffersInserts = {}
+    self.vimProxyInId = 0
+    self.vimProxyOutId = 0
+    self.attached = False
+    self.inserted = 0
+    self.acked = 0
+    self.notified = False
+    self.transport = None
+    self.authenticated = self.main.secret == None
+
+  def vimDisconnected(self):
+    log.info("ProcRunner.vimDisconnected: keeping %d jobs", len(self.processes))
+    self.vimSocket = None
+    self.attached = not self.main.persistent
 
   def onFileOpened(self, filename, opened, modified):
     NetBeans.onFileOpened(self, filename, opened, modified)
@@ -459,15 +2045,231 @@ class ProcRunner(NetBeans, Proxy.Handler):
     pass
 
 
+# class ShardWorker
+# Runs the jobs given by the front process (see ShardedRunner) on
+# shardSocket: all job I/O, filtering, scrollback, cache and credits happen
+# here. Commands are received one per line, escaped for NetBeans. Messages
+# are sent escaped already, one per line as '<job id or -> <message>'.
+class ShardWorker(ProcRunner):
+
+  def __init__(self, main, shardSocket):
+    ProcRunner.__init__(self, main, shardSocket)
+    self.attached = True
+
+  def fromVim(self, data):
+    self.command(unescapeNetBeans(data))
+
+  # attachSession(): only the front process talks to vim, a new session
+  # drops the jobs of the previous one
+  def attachSession(self, token):
+    if self.session != None and self.session != token:
+      self.dropJobs()
+    self.session = token
+
+  def flush(self):
+    out = []
+    while len(out) < self.maxBurst:
+      msg = self.lanes.pop()
+      if msg == None: break
+      (id, data) = msg
+      if id == None: id = '-'
+      out.append("%s %s\n" % (id, escapeNetBeans(data.strip())))
+
+    if len(out):
+      self.writeRawToVim(''.join(out))
+
+# class ShardedRunner
+# Front process of the sharded mode: talks to vim, sends the commands of a
+# job to the shard running it and queues shard messages in the job lane.
+# A job goes to shard (id % nb shards), or (hash(key) % nb shards) for jobs
+# with a key so that they can supersede each other. A cached job goes to
+# the shard of its command, which caches its result. A watch stays
+# registered until ##_UNWATCH_, its job runs again on file changes.
+# Shard sockets are read by the proxy like job outputs.
+class ShardedRunner(ProcRunner):
+
+  def __init__(self, main, vimSocket, shardSockets):
+    ProcRunner.__init__(self, main, vimSocket)
+
+    self.shards       = shardSockets
+    self.invShards    = dict([(s.fileno(), s) for s in shardSockets]) # { desc : socket }
+    self.jobShards    = {} # { id : socket }
+    self.runningJobs  = set()
+    self.watchJobs    = set() # id of watches, their job runs again until ##_UNWATCH_
+
+    self.reProtoJobCmd  = re.compile("^##_[A-Z]+_(\d+)_")
+    self.protoSession   = "##_SESSION_%s_##"
+
+  # createCache(): results are cached by the shards, each in its own
+  # directory, the front doesn't touch cacheDir
+  def createCache(self):
+    return ResultCache(DEFAULT_CACHE_SIZE)
+
+  def command(self, data):
+    for r in [self.reProtoSessionCmd, self.reProtoPauseCmd, self.reProtoAckCmd]:
+      if r.match(data):
+        return ProcRunner.command(self, data)
+
+    for r in [self.reProtoContinueCmd, self.reProtoProfileCmd, self.reProtoMemoryCmd, self.reProtoWatchdogCmd]:
+      if r.match(data):
+        ProcRunner.command(self, data)
+        for shard in self.shards:
+          self.sendToShard(shard, data)
+        return
+
+    m = self.reProtoExecCmd.match(data)
+    if m != None:
+      return self.requestShardJob(m, data)
+
+    m = self.reProtoWatchCmd.match(data)
+    if m != None:
+      return self.requestShardJob(m, data, True)
+
+    m = self.reProtoJobCmd.match(data)
+    if m != None and not self.jobShards.has_key(int(m.group(1))) and self.reProtoFeedCmd.match(data):
+      # rejected here, its temporary file removed
+      return ProcRunner.command(self, data)
+
+    if m == None or not self.jobShards.has_key(int(m.group(1))):
+      log.error("ShardedRunner.command: data out of protocol or unknown job: '%s'", data)
+      return
+
+    id = int(m.group(1))
+    self.sendToShard(self.jobShards[id], data)
+
+    if self.reProtoUnwatchCmd.match(data) and id in self.watchJobs:
+      self.watchJobs.discard(id)
+      self.runningJobs.discard(id)
+      self.jobLanes.pop(id, None)
+
+  def requestShardJob(self, m, data, watch=False):
+    try:
+      id = int(m.group(1))
+      options = {}
+      if m.group(3) != None:
+        options = json.loads(m.group(3))
+    except:
+      log.exception("ShardedRunner.requestShardJob: exception")
+      return
+
+    self.lastJobId = max(self.lastJobId, id)
+
+    self.jobLanes[id] = LANE_BULK
+    if toInt(options.get('interactive')) != 0:
+      self.jobLanes[id] = LANE_INTERACTIVE
+
+    key = options.get('key')
+    if key != None: index = hash(key) % len(self.shards)
+    elif toInt(options.get('cache')) != 0: index = hash((m.group(2), repr(options.get('cwd')))) % len(self.shards)
+    else: index = id % len(self.shards)
+
+    self.jobShards[id] = self.shards[index]
+    self.runningJobs.add(id)
+    if watch: self.watchJobs.add(id)
+    self.sendToShard(self.shards[index], data)
+
+  def sendToShard(self, shard, data):
+    try: shard.sendall(escapeNetBeans(data) + "\n")
+    except:
+      log.exception("ShardedRunner.sendToShard: exception")
+      return False
+    return True
+
+  def fromProc(self, desc, data):
+    try:
+      (id, data) = data.split(' ', 1)
+      if id == '-': id = None
+      else: id = int(id)
+    except ValueError:
+      log.error("ShardedRunner.fromProc: invalid shard message: '%s'", data)
+      return
+
+    if id != None:
+      if not self.jobShards.has_key(id): return # dropped
+      if data.startswith("##_TERMINATED_") or data.startswith("##_CANCELLED_"):
+        self.sendToVim(data, id)
+        if id not in self.watchJobs:
+          self.runningJobs.discard(id)
+          self.jobLanes.pop(id, None)
+        return
+
+    self.sendToVim(data, id)
+
+  # procEnded(): a shard died, its jobs are lost
+  def procEnded(self, desc):
+    shard = self.invShards.pop(desc)
+    self.shards.remove(shard)
+    log.error("ShardedRunner.procEnded: shard lost, %d shards left", len(self.shards))
+
+    for (id, jobShard) in self.jobShards.items():
+      if jobShard != shard: continue
+      del self.jobShards[id]
+      self.watchJobs.discard(id)
+      if id in self.runningJobs:
+        self.runningJobs.discard(id)
+        self.sendToVim(self.protoTerminated % (id, 255), id)
+
+    if not len(self.shards):
+      self.main.proxy.stop()
+
+  def attachSession(self, token):
+    for shard in self.shards:
+      self.sendToShard(shard, self.protoSession % (token))
+    ProcRunner.attachSession(self, token)
+
+  def jobIds(self):
+    return set(self.runningJobs)
+
+  def dropJobs(self):
+    for id in self.runningJobs:
+      self.jobShards.pop(id, None)
+    self.runningJobs = set()
+    self.watchJobs = set()
+    self.lanes = MessageLanes()
+
+  # pauseDetachedJobs(): stop reading shards, their jobs are blocked once
+  # the shard sockets are full
+  def pauseDetachedJobs(self):
+    if len(self.lanes) < DEFAULT_DETACHED_MAX_MESSAGES: return
+    if len(self.detachPaused): return
+
+    for desc in self.invShards.keys():
+      self.detachPaused.add(desc)
+      self.main.proxy.pauseProc(desc)
+
+  def resumeDetachedJobs(self):
+    for desc in self.detachPaused:
+      self.main.proxy.resumeProc(desc)
+    self.detachPaused = set()
+
+  def describe(self, desc):
+    if self.invShards.has_key(desc): return 'shard socket %d' % (desc)
+    return ProcRunner.describe(self, desc)
+
+  # writeMessage(): shard messages are escaped already, so are control
+  # messages of the front which have nothing to escape
+  def writeMessage(self, data):
+    self.insert(self.vimProxyInId, 99999, data.strip(), escaped=True)
+
+  def channelLine(self, data):
+    return unescapeNetBeans(data.strip())
+
 class Main:
 
-  def __init__(self, daemon, netbeansPort):
+  def __init__(self, daemon, netbeansPort, cacheDir=None, idleTimeout=0, shards=0, watchdog=0):
     self.daemon           = daemon
     self.netbeansPort     = netbeansPort
+    self.cacheDir         = cacheDir
+    self.idleTimeout      = idleTimeout
+    self.persistent       = idleTimeout > 0
+    self.shards           = shards
+    self.watchdog         = watchdog
+    self.secret           = None # vim must send it first, see writeSecret()
 
     self.netbeans         = None
 
     self.proxy            = None
+    self.terminating      = False # SIGTERM received
 
   @CatchAndLogException
   def run(self):
@@ -476,20 +2278,104 @@ class Main:
         log.error("Main.run: unable to become a daemon")
         return False
 
-    vimSocket = self.startServerAndWaitVim(DEFAULT_NETBEANS_INTERFACE, self.netbeansPort)
-    if vimSocket == None:
-      log.error("Main.run: unable to startServerAndWaitVim")
+    server = self.startServer(DEFAULT_NETBEANS_INTERFACE, self.netbeansPort)
+    if server == None:
+      log.error("Main.run: unable to startServer")
+      return False
+
+    # once listening: a daemon already on the port keeps its secret
+    if not self.writeSecret():
+      log.error("Main.run: unable to writeSecret")
       return False
 
-    self.netbeans = ProcRunner(self, vimSocket)
+    shardSockets = []
+    if self.shards > 0:
+      shardSockets = self.startShards(server)
+      if shardSockets == None:
+        log.error("Main.run: unable to startShards")
+        self.removeRuntimeFiles()
+        return False
 
-    self.proxy = Proxy(vimSocket, self.netbeans)
+    self.writePidFile()
 
-    self.proxy.run()
+    # interrupts waitVim()
+    signal.signal(signal.SIGTERM, self.onTerminate)
+
+    vimSocket = self.waitVim(server)
+    if self.terminating:
+      self.removeRuntimeFiles()
+      return True
 
+    if vimSocket == None:
+      log.error("Main.run: unable to waitVim")
+      self.removeRuntimeFiles()
+      return False
+
+    if len(shardSockets):
+      self.netbeans = ShardedRunner(self, vimSocket, shardSockets)
+    else:
+      self.netbeans = ProcRunner(self, vimSocket)
+
+    self.proxy = Proxy(vimSocket, self.netbeans)
+    if self.persistent:
+      self.proxy.setServer(server, self.idleTimeout)
+    if self.watchdog > 0:
+      self.proxy.setWatchdog(self.watchdog)
+    self.installSignals()
+
+    for shard in shardSockets:
+      self.proxy.addProc(shard.fileno())
+
+    if not self.terminating:
+      self.proxy.run()
+
+    # idle timeout, SIGTERM or vim gone: don't leave jobs behind
+    self.netbeans.stopJobs()
+    self.netbeans.spools.clear()
+    self.removeRuntimeFiles()
     log.info("Main.run: this is the end my friends")
     return True
 
+  # installSignals(): diagnostics on SIGUSR1 and SIGUSR2, see
+  # ProcRunner.handleSignals(), SIGTERM stops the proxy. System calls are
+  # restarted, select() is interrupted and handled by the proxy.
+  def installSignals(self):
+    for signum in [signal.SIGUSR1, signal.SIGUSR2]:
+      signal.signal(signum, self.netbeans.onSignal)
+      signal.siginterrupt(signum, False)
+    signal.signal(signal.SIGTERM, self.onTerminate)
+    signal.siginterrupt(signal.SIGTERM, False)
+
+  def onTerminate(self, signum, frame):
+    log.info("Main.onTerminate: terminating")
+    self.terminating = True
+    if self.proxy != None: self.proxy.stop()
+
+  # writePidFile(): in the directory made by writeSecret()
+  def writePidFile(self):
+    try: writePrivateFile(pidFilename(self.netbeansPort), "%d\n" % (os.getpid()))
+    except OSError:
+      log.exception("Main.writePidFile: exception: ")
+
+  # writeSecret(): vim reads it from secretFilename() and sends it first,
+  # other users may connect to the port but can't read it
+  def writeSecret(self):
+    try:
+      makeRuntimeDir()
+      # vim cuts :nbstart passwords over 25 chars
+      secret = binascii.hexlify(os.urandom(12))
+      writePrivateFile(secretFilename(self.netbeansPort), secret + "\n")
+    except OSError:
+      log.exception("Main.writeSecret: exception: ")
+      return False
+    self.secret = secret
+    return True
+
+  def removeRuntimeFiles(self):
+    for filename in [pidFilename(self.netbeansPort), secretFilename(self.netbeansPort)]:
+      try: os.remove(filename)
+      except OSError: pass
+
   def createDaemon(self):
     try: pid = os.fork()
     except:
@@ -505,21 +2391,68 @@ class Main:
     os.setsid()
     return True
 
-  def startServerAndWaitVim(self, interface, port):
+  # startShards(): fork the shard processes, return the sockets to them
+  def startShards(self, server):
+    shards = []
+    for index in range(self.shards):
+      (front, back) = socket.socketpair()
+      try: pid = os.fork()
+      except OSError:
+        log.exception("Main.startShards: unable to fork")
+        return None
+
+      if pid == 0:
+        # shard
+        server.close()
+        front.close()
+        for shard in shards: shard.close()
+        self.runShard(index, back)
+        os._exit(0)
+
+      back.close()
+      shards.append(front)
+
+    log.info("Main.startShards: %d shards started", len(shards))
+    return shards
+
+  # runShard(): a shard caches results in its own subdirectory of cacheDir
+  def runShard(self, index, shardSocket):
+    log.info("Main.runShard: shard %d running", index)
+    self.persistent = False
+    if self.cacheDir != None:
+      self.cacheDir = os.path.join(self.cacheDir, 'shard-%d' % (index))
+    self.netbeans = ShardWorker(self, shardSocket)
+    self.proxy = Proxy(shardSocket, self.netbeans)
+    if self.watchdog > 0:
+      self.proxy.setWatchdog(self.watchdog)
+    self.installSignals()
+    if not self.terminating:
+      self.proxy.run()
+
+    # front is gone, don't leave jobs behind
+    self.netbeans.stopJobs()
+    self.netbeans.spools.clear()
+    log.info("Main.runShard: shard %d ended", index)
+
+  def startServer(self, interface, port):
     try:
       server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
       server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
       server.bind((interface, port))
       server.listen(1)
     except Exception as e:
-      log.exception("Main.startServerAndWaitVim: got exception: ")
+      log.exception("Main.startServer: got exception: ")
       return None
 
+    log.info("Listening on port %d", port)
+    return server
+
+  def waitVim(self, server):
     try:
-      log.info("Listening on port %d, waiting for connection", port)
+      log.info("Waiting for connection")
       (con, addr) = server.accept()
     except:
-      log.error("Main.startServerAndWaitVim: interrupted while waiting for connection")
+      log.error("Main.waitVim: interrupted while waiting for connection")
       return None
 
     log.debug("Vim is here! :)")
@@ -539,6 +2472,18 @@ def main():
                     dest='background',
                     action="store_true",
                     help='become a daemon')
+  parser.add_option('-c', '--cache-dir',
+                    dest='cacheDir',
+                    help='keep cached job results in this directory')
+  parser.add_option('-i', '--idle-timeout',
+                    dest='idleTimeout',
+                    help='keep running jobs when vim disconnects, stop after this many seconds without vim')
+  parser.add_option('-s', '--shards',
+                    dest='shards',
+                    help='run jobs in this many processes, for heavy job output')
+  parser.add_option('-w', '--watchdog',
+                    dest='watchdog',
+                    help='log what blocks the daemon for this many milliseconds or longer')
 
   (options, args) = parser.parse_args()
 
@@ -561,7 +2506,28 @@ def main():
 
   log.debug("Starting")
 
-  main = Main(daemon, port)
+  idleTimeout = 0
+  if options.idleTimeout != None:
+    try: idleTimeout = int(options.idleTimeout)
+    except:
+      log.error("Invalid idle timeout ("+options.idleTimeout+")")
+      return 1
+
+  shards = 0
+  if options.shards != None:
+    try: shards = int(options.shards)
+    except:
+      log.error("Invalid number of shards ("+options.shards+")")
+      return 1
+
+  watchdog = 0
+  if options.watchdog != None:
+    try: watchdog = int(options.watchdog)
+    except:
+      log.error("Invalid watchdog threshold ("+options.watchdog+")")
+      return 1
+
+  main = Main(daemon, port, options.cacheDir, idleTimeout, shards, watchdog)
   if not main.run():
     log.error("Ended with errors, see logs for details")
     return 1
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Throughput of python/Codec.py against the former chained str.replace()
+# usage: BenchCodec.py [size in MB]
+
+import time
+import os
+import sys
+sys.path.append(os.path.dirname(sys.argv[0])+"/../python")
+from Codec import *
+
+def oldEscape(text):
+  return text.replace("\\", "\\\\").replace('"', '\\"')
+
+def oldUnescape(text):
+  return text.replace("\\\"", "\"").replace("\\\\", "\\")
+
+def payloads(size):
+  plain = "gcc -O2 -Wall -c src/module.c -o build/module.o"
+  quoted = 'src/a.c:12:3: error: expected ";" before "}" token \\ \x1b[31m\xff\xfe'
+  return [
+    ('plain', plain, size / len(plain)),
+    ('quoted', quoted, size / len(quoted))
+  ]
+
+# bench(): run fct on one large payload, then line by line as the daemon does
+def bench(name, fct, line, count):
+  data = "\n".join([line] * count)
+  lines = [line] * count
+
+  start = time.time()
+  fct(data)
+  large = len(data) / (time.time() - start) / 1024 / 1024
+
+  start = time.time()
+  for l in lines:
+    fct(l)
+  perLine = len(data) / (time.time() - start) / 1024 / 1024
+
+  print("%-20s %8.1f MB/s large, %8.1f MB/s per line" % (name, large, perLine))
+
+def main():
+  size = 16
+  if len(sys.argv) > 1:
+    size = int(sys.argv[1])
+  size *= 1024 * 1024
+
+  for (kind, line, count) in payloads(size):
+    print("-- %s payload, %d MB" % (kind, size / 1024 / 1024))
+    escaped = escapeNetBeans(line)
+    assert unescapeNetBeans(escaped) == line
+    bench('replace escape', oldEscape, line, count)
+    bench('escapeNetBeans', escapeNetBeans, line, count)
+    bench('replace unescape', oldUnescape, oldEscape(line), count)
+    bench('unescapeNetBeans', unescapeNetBeans, escaped, count)
+    bench('escapeVimString', escapeVimString, line, count)
+
+  return 0
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Stand-in for vim on the channel transport: connects to a running
+# VimProcRunner.py as ch_open() with {'mode': 'nl'} does, sends the daemon
+# secret and a session then the given protocol messages, and prints the messages received until
+# the daemon is quiet for a second.
+# usage: ChannelClient.py port '##_EXEC_1_[ls]_##' ...
+
+import time
+import socket
+import select
+import sys
+import os
+sys.path.append(os.path.dirname(sys.argv[0])+"/../python")
+from VimProcRunner import secretFilename
+
+def main():
+  if len(sys.argv) < 2:
+    print "usage: %s port [message...]" % (sys.argv[0])
+    return 1
+
+  f = open(secretFilename(int(sys.argv[1])))
+  try: secret = f.read().strip()
+  finally: f.close()
+
+  con = socket.create_connection(('127.0.0.1', int(sys.argv[1])))
+  con.sendall("##_AUTH_%s_##\n" % (secret))
+  con.sendall("##_SESSION_channelclient_##\n")
+  for msg in sys.argv[2:]:
+    con.sendall(msg + "\n")
+
+  start = time.time()
+  count = 0
+  buf = ''
+  while True:
+    (i, o, e) = select.select([con], [], [], 1.0)
+    if not len(i): break
+    data = con.recv(65536)
+    if not len(data): break
+    buf += data
+    lines = buf.split("\n")
+    buf = lines.pop()
+    for line in lines:
+      print line
+      count += 1
+
+  con.close()
+  print "%d messages in %.3f sec" % (count, time.time() - start - 1.0)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
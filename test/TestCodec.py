@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Checks that python/Codec.py escapes round-trip: NetBeans strings give
+# back the text, vim strings read back as the text, NUL aside.
+# usage: TestCodec.py
+
+import os
+import sys
+sys.path.append(os.path.dirname(sys.argv[0])+"/../python")
+from Codec import *
+
+TEXTS = [
+  '',
+  'gcc -O2 -Wall -c src/module.c -o build/module.o',
+  'src/a.c:12:3: error: expected ";" before "}" token',
+  'C:\\path\\to\\file',
+  'backslash then n: \\n, newline: \n, both: \\\n',
+  'trailing backslash \\',
+  '\\\\"\\"',
+  'tab\there, cr\rthere',
+  'ansi \x1b[31mred\x1b[0m, del \x7f',
+  'latin-1 \xe9, utf-8 \xc3\xa9, broken utf-8 \xff\xfe',
+  ''.join([chr(c) for c in range(1, 256)])
+]
+
+def check(what, expected, got):
+  if expected == got:
+    print "ok: %s" % (what)
+    return True
+  print "FAILED: %s:\n  expected %r\n  got      %r" % (what, expected, got)
+  return False
+
+def main():
+  ok = True
+
+  for text in TEXTS:
+    ok &= check("netbeans round-trip %r" % (text[:20]), text, unescapeNetBeans(escapeNetBeans(text)))
+
+  # one line once escaped, as the daemon inserts it in the .in buffer
+  escaped = [escapeNetBeans(text) for text in TEXTS]
+  ok &= check("netbeans escapes newlines", 0, len([e for e in escaped if "\n" in e or "\r" in e]))
+
+  ok &= check("netbeans drops NUL", 'ab', unescapeNetBeans(escapeNetBeans('a\0b')))
+  ok &= check("netbeans unknown escape", '\\x', unescapeNetBeans('\\x'))
+
+  # vim double quoted strings read \\ \" and \x.. as python does
+  for text in TEXTS:
+    ok &= check("vim string round-trip %r" % (text[:20]), text, escapeVimString(text).decode('string_escape'))
+
+  ok &= check("vim string drops NUL", 'ab', escapeVimString('a\0b'))
+  ok &= check("vim string control", 'a\\x1bb\\x0a', escapeVimString('a\x1bb\n'))
+
+  return 0 if ok else 1
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs a ProcRunner over a socket pair standing for vim and checks that the
+# 'credits' ##_EXEC_ option stops the job output until more credits are
+# granted, and that ##_TERMINATED_ is sent without credits.
+# usage: TestCredits.py
+
+import os
+import sys
+import time
+import socket
+import threading
+sys.path.append(os.path.dirname(sys.argv[0])+"/../python")
+from VimProcRunner import *
+
+LogSetup().setup('', 'TestCredits.log')
+
+# class FakeMain
+# What ProcRunner uses of Main
+class FakeMain:
+  cacheDir    = None
+  persistent  = False
+  proxy       = None
+  secret      = None
+
+# class FakeVim
+# Reads what the daemon inserts in the .in buffer (bufId 1), sends
+# protocol messages as insertions in the .out buffer (bufId 2).
+class FakeVim:
+
+  def __init__(self, sock):
+    self.sock     = sock
+    self.messages = []
+    self.thread   = threading.Thread(target=self.read)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def read(self):
+    buf = ''
+    while True:
+      data = self.sock.recv(65536)
+      if not len(data): return
+      buf += data
+      lines = buf.split("\n")
+      buf = lines.pop()
+      for line in lines:
+        if line.startswith('1:insert/'):
+          self.messages.append(unescapeNetBeans(line.split(' ', 2)[2][1:-1]))
+
+  def close(self):
+    self.sock.shutdown(socket.SHUT_RDWR)
+    self.thread.join()
+
+  def send(self, msg):
+    self.sock.sendall('2:insert=1 0 "%s"\n' % (escapeNetBeans(msg)))
+
+  def count(self, prefix):
+    return len([m for m in self.messages if m.startswith(prefix)])
+
+def check(what, expected, got):
+  if expected == got:
+    print "ok: %s: %d" % (what, got)
+    return True
+  print "FAILED: %s: expected %d, got %d" % (what, expected, got)
+  return False
+
+def main():
+  (daemonSocket, vimSocket) = socket.socketpair()
+
+  m = FakeMain()
+  runner = ProcRunner(m, daemonSocket)
+  runner.vimProxyInId = 1
+  runner.vimProxyOutId = 2
+  m.proxy = Proxy(daemonSocket, runner)
+
+  loop = threading.Thread(target=m.proxy.run)
+  loop.start()
+
+  vim = FakeVim(vimSocket)
+  ok = True
+  try:
+    vim.send('##_EXEC_13_[seq 1 200000]_##{"credits": 3}')
+    time.sleep(1.0)
+    ok &= check("lines sent with 3 credits", 3, vim.count('##_DATA_13_##'))
+
+    vim.send('##_CREDIT_13_2_0_##')
+    time.sleep(1.0)
+    ok &= check("lines sent with 2 credits more", 5, vim.count('##_DATA_13_##'))
+    ok &= check("terminated while out of credits", 0, vim.count('##_TERMINATED_13_'))
+
+    vim.send('##_CREDIT_13_UNLIMITED_##')
+    deadline = time.time() + 30.0
+    while not vim.count('##_TERMINATED_13_') and time.time() < deadline:
+      time.sleep(0.2)
+    ok &= check("lines sent once unlimited", 200000, vim.count('##_DATA_13_##'))
+    ok &= check("terminated once unlimited", 1, vim.count('##_TERMINATED_13_0_##'))
+
+    # the status costs no credit: a job using all of its credits ends
+    vim.send('##_EXEC_14_[seq 1 3]_##{"credits": 3}')
+    time.sleep(1.0)
+    ok &= check("lines sent with as many credits", 3, vim.count('##_DATA_14_##'))
+    ok &= check("terminated with no credit left", 1, vim.count('##_TERMINATED_14_0_##'))
+  finally:
+    m.proxy.stop()
+    loop.join()
+    vim.close()
+
+  return 0 if ok else 1
+
+if __name__ == '__main__':
+  sys.exit(main())
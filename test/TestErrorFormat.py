@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Copyright 2012 Jeanluc Chasseriau <jeanluc@lo.cx>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Feeds gcc, make and python traceback output to ErrorFormat.QuickfixParser
+# and checks the quickfix records it gives, as vim would build them from the
+# same 'errorformat'.
+# usage: TestErrorFormat.py
+
+import os
+import sys
+sys.path.append(os.path.dirname(sys.argv[0])+"/../python")
+from LogBeans import *
+from ErrorFormat import *
+
+LogSetup().setup('', 'TestErrorFormat.log')
+
+GCC_EFM = "%Dmake: Entering directory '%f',%Xmake: Leaving directory '%f'," \
+          "%f:%l:%c: %t%*[^:]: %m,%f:%l: %t%*[^:]: %m,%-G%.%#"
+
+GCC_OUTPUT = [
+  "make: Entering directory '/work/lib'",
+  "gcc -O2 -Wall -c b.c -o b.o",
+  "b.c: In function 'main':",
+  "b.c:12:3: error: expected ';' before '}' token",
+  "b.c:4: warning: unused variable 'x'",
+  "make: Leaving directory '/work/lib'",
+  "src/a.c:7:1: error: unknown type name 'foo'",
+  "make: *** [all] Error 1"
+]
+
+GCC_RECORDS = [
+  {'filename': '/work/lib/b.c', 'lnum': 12, 'col': 3, 'type': 'e', 'text': "expected ';' before '}' token", 'valid': 1},
+  {'filename': '/work/lib/b.c', 'lnum': 4, 'type': 'w', 'text': "unused variable 'x'", 'valid': 1},
+  {'filename': '/work/src/a.c', 'lnum': 7, 'col': 1, 'type': 'e', 'text': "unknown type name 'foo'", 'valid': 1}
+]
+
+PYTHON_EFM = '%A  File "%f"\\, line %l\\, in %o,%-C    %.%#,%Z%m,%-G%.%#'
+
+PYTHON_OUTPUT = [
+  "Traceback (most recent call last):",
+  '  File "run.py", line 10, in <module>',
+  "    main()",
+  '  File "/usr/lib/tool.py", line 3, in main',
+  '    raise ValueError("bad")',
+  "ValueError: bad"
+]
+
+PYTHON_RECORDS = [
+  {'filename': '/work/run.py', 'lnum': 10, 'module': '<module>', 'valid': 1},
+  {'filename': '/usr/lib/tool.py', 'lnum': 3, 'module': 'main', 'text': 'ValueError: bad', 'valid': 1}
+]
+
+def check(what, expected, got):
+  if expected == got:
+    print "ok: %s" % (what)
+    return True
+  print "FAILED: %s:\n  expected %r\n  got      %r" % (what, expected, got)
+  return False
+
+# parse(): records of all the lines, then of the end of the output
+def parse(parser, lines):
+  records = []
+  for line in lines:
+    records.extend(parser.feed(line))
+  records.extend(parser.finish())
+  return records
+
+def main():
+  ok = True
+
+  parser = createQuickfixParser({'errorformat': GCC_EFM, 'cwd': '/work'})
+  ok &= check("gcc records", GCC_RECORDS, parse(parser, GCC_OUTPUT))
+
+  parser = createQuickfixParser({'errorformat': PYTHON_EFM, 'cwd': '/work'})
+  ok &= check("python traceback records", PYTHON_RECORDS, parse(parser, PYTHON_OUTPUT))
+
+  # the traceback ends with the output: the last record is given by finish()
+  parser = QuickfixParser(PYTHON_EFM)
+  records = parse(parser, PYTHON_OUTPUT[:3])
+  ok &= check("traceback cut short", [{'filename': 'run.py', 'lnum': 10, 'module': '<module>', 'valid': 1}], records)
+
+  # without %G, lines not matching give invalid records as in vim
+  parser = QuickfixParser(['%f:%l: %m'])
+  records = parse(parser, ["x.c:1: boom", "make: *** [all] Error 1"])
+  ok &= check("unmatched line", [{'filename': 'x.c', 'lnum': 1, 'text': 'boom', 'valid': 1},
+                                 {'text': 'make: *** [all] Error 1', 'valid': 0}], records)
+
+  ok &= check("no errorformat", None, createQuickfixParser({}))
+  ok &= check("invalid errorformat", None, createQuickfixParser({'errorformat': '%f:%l:%*'}))
+
+  return 0 if ok else 1
+
+if __name__ == '__main__':
+  sys.exit(main())